@@ -20,24 +20,79 @@ Contributors:
     :: H. Kamran [@hkamran80] (author)
 """
 
-import dateutil.relativedelta
-import aiohttp_client_cache
-import asyncspotify
+from __future__ import annotations
+
+import importlib.util
+import importlib
+import urllib.parse
 import collections
 import dataclasses
-import termcolor
+import contextvars
+import contextlib
+import itertools
 import datetime
 import asyncio
-import aiohttp
-import dotenv
+import sqlite3
+import hashlib
 import typing
+import bisect
+import heapq
+import array
+import types
 import enum
 import json
 import time
 import math
+import glob
+import sys
+import csv
 import os
 
-dotenv.load_dotenv()
+
+def lazy_import(name: str) -> types.ModuleType:
+    """
+    Imports a module the first time one of its attributes is used, returning
+    the top-level package like an `import` statement would
+    """
+
+    package = name.partition(".")[0]
+    if name in sys.modules:
+        return sys.modules[package]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.loader is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+
+    parent, _, child = name.rpartition(".")
+    if parent:
+        setattr(sys.modules[parent], child, module)
+
+    return sys.modules[package]
+
+
+# Dependencies are only imported once they're used, so runs that never reach
+# them (e.g. answered from stored results) don't pay for importing them
+aiohttp_client_cache = lazy_import("aiohttp_client_cache")
+dateutil = lazy_import("dateutil.relativedelta")
+termcolor = lazy_import("termcolor")
+aiohttp = lazy_import("aiohttp")
+numpy = lazy_import("numpy")
+
+# Parquet history exports and the faster JSON decoder are optional
+pyarrow = lazy_import("pyarrow") if importlib.util.find_spec("pyarrow") else None
+orjson = lazy_import("orjson") if importlib.util.find_spec("orjson") else None
+
+# Only running the analyzer reads the `.env` file, importing it doesn't
+if __name__ == "__main__":
+    import dotenv
+
+    dotenv.load_dotenv()
 
 USERNAME = os.environ.get("USERNAME", None)
 LAST_FM_API_KEY = os.environ.get("LAST_FM_API_KEY", None)
@@ -46,33 +101,96 @@ SPOTIFY_CLIENT_SECRET = os.environ.get("SPOTIFY_CLIENT_SECRET", None)
 RAW_DUMP = os.environ.get("RAW_DUMP", False)
 OUTPUT = os.environ.get("ANALYZER_OUTPUT", False)
 HISTORY_OUTPUT = os.environ.get("HISTORY_OUTPUT", False)
-
-BASE_URL = "https://ws.audioscrobbler.com/2.0/"
+FULL_RESYNC = os.environ.get("FULL_RESYNC", False)
+KEEPALIVE_TIMEOUT = float(os.environ.get("KEEPALIVE_TIMEOUT", 30))
+MAX_RETRIES = int(os.environ.get("MAX_RETRIES", 5))
+RANKING_SIZE = int(os.environ.get("RANKING_SIZE", 0))
+APPROXIMATE_CAPACITY = int(os.environ.get("APPROXIMATE_CAPACITY", 0))
+ANALYZER_HOST = os.environ.get("ANALYZER_HOST", "127.0.0.1")
+ANALYZER_PORT = int(os.environ.get("ANALYZER_PORT", 8080))
+ANALYZER_SOCKET = os.environ.get("ANALYZER_SOCKET", None)
+METRICS_OUTPUT = os.environ.get("METRICS_OUTPUT", False)
+PROMETHEUS_OUTPUT = os.environ.get("PROMETHEUS_OUTPUT", False)
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 4))
+
+# Endpoints of each backend, which can be pointed at `stub_server.py` to run
+# without network access or API keys
+BASE_URL = os.environ.get("LAST_FM_URL", "https://ws.audioscrobbler.com/2.0/")
+SPOTIFY_API_URL = os.environ.get("SPOTIFY_API_URL", "https://api.spotify.com/v1")
+SPOTIFY_ACCOUNTS_URL = os.environ.get(
+    "SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com/api/token"
+)
+MUSICBRAINZ_URL = os.environ.get("MUSICBRAINZ_URL", "https://musicbrainz.org/ws/2")
 HEADERS = {"User-Agent": "Acoustats Analyzer/1.0.0 ( hkamran@unisontech.org )"}
 
-WORK_QUEUE = asyncio.Queue()
-WORK_QUEUE_OUTPUT = []
-ERROR = None
 SPOTIFY_ACCESS_TOKEN = None
+SPOTIFY_ACCESS_TOKEN_EXPIRES = 0.0
+# Renew client credentials tokens this many seconds before they expire
+SPOTIFY_TOKEN_MARGIN = 600
+# The most tracks retrieved from Spotify in a single request
+SPOTIFY_BATCH_SIZE = 50
+# The most scrobbles Last.fm returns in a page of recent tracks (instead of
+# its default of 50)
+RECENT_TRACKS_LIMIT = 200
+# The most tracks searched for on MusicBrainz in a single (OR-ed) query,
+# which returns up to 100 recordings
+MUSICBRAINZ_BATCH_SIZE = 10
+
+# Maximum simultaneous connections to each backend, can be overridden with
+# `CONNECTION_LIMITS` (e.g. `lastfm=10,musicbrainz=1`)
+CONNECTION_LIMITS = {
+    "lastfm": 10,
+    "spotify": 10,
+    "musicbrainz": 2,
+    **{
+        backend.strip(): int(limit)
+        for backend, limit in [
+            item.split("=")
+            for item in os.environ.get("CONNECTION_LIMITS", "").split(",")
+            if "=" in item
+        ]
+    },
+}
+
+# Requests per second sent to each backend, can be overridden with
+# `RATE_LIMITS` (e.g. `lastfm=5,musicbrainz=1`)
+RATE_LIMITS = {
+    "lastfm": 5,
+    "spotify": 10,
+    # https://musicbrainz.org/doc/MusicBrainz_API/Rate_Limiting
+    "musicbrainz": 1,
+    **{
+        backend.strip(): float(limit)
+        for backend, limit in [
+            item.split("=")
+            for item in os.environ.get("RATE_LIMITS", "").split(",")
+            if "=" in item
+        ]
+    },
+}
+
+# Minimum, initial, and maximum concurrency of each pipeline stage
+STAGE_CONCURRENCY = {
+    "GRT": (1, 5, 10),
+    "GTI": (1, 5, 20),
+    "SFTD": (1, 5, 10),
+    "SFTB": (1, 2, 5),
+    "MBD": (1, 1, 1),
+}
+
+# How long resolved durations are kept for, by source, in seconds. Tracks no
+# source had a duration for are retried sooner.
+METADATA_TTLS = {
+    "lastfm": 2628000,
+    "spotify": 7884000,
+    "musicbrainz": 15768000,
+    "miss": 604800,
+}
+
 BasicTrackInfo = collections.namedtuple("BasicTrackInfo", "name artist album mbid")
 VeryBasicTrackInfo = collections.namedtuple("VeryBasicTrackInfo", "name artist")
-
-# Normal cache expires after a month
-ASYNC_CACHE = aiohttp_client_cache.SQLiteBackend(
-    cache_name="analyzer_tracks_cache",
-    expire_after=2628000,
-    allowed_methods=("GET", "POST"),
-    allowed_codes=(200,),
-    ignored_params=["api_key"],
-)
-
-# User cache expires after a week
-ASYNC_USER_CACHE = aiohttp_client_cache.SQLiteBackend(
-    cache_name=f"analyzer_lastfm_user_{USERNAME}",
-    expire_after=86400,
-    allowed_methods=("GET", "POST"),
-    allowed_codes=(200,),
-    ignored_params=["api_key"],
+RecentTracksRequest = collections.namedtuple(
+    "RecentTracksRequest", "username page start end"
 )
 
 
@@ -102,11 +220,6 @@ class RecentTrack(Track):
     epoch_started: int
 
 
-@dataclasses.dataclass
-class RecentTrackWithDuration(RecentTrack):
-    duration: int
-
-
 @dataclasses.dataclass
 class TrackInfo(Track):
     duration: int
@@ -137,6 +250,45 @@ class Timeframe(enum.Enum):
     def list_values(cls):
         return list(map(lambda c: c.value, cls))
 
+    def bounds(
+        self, today: typing.Union[datetime.date, None] = None
+    ) -> typing.Tuple[int, int]:
+        """
+        Returns the timeframe as a `(start, end)` pair of epoch timestamps in
+        local time, with the end being exclusive
+        """
+
+        today = today or datetime.date.today()
+        week_start = last_sunday(today + datetime.timedelta(days=1))
+        month_start = today.replace(day=1)
+        year_start = today.replace(month=1, day=1)
+
+        if self == Timeframe.TODAY:
+            start, end = today, today + datetime.timedelta(days=1)
+        elif self == Timeframe.THIS_WEEK:
+            start, end = week_start, week_start + datetime.timedelta(weeks=1)
+        elif self == Timeframe.THIS_MONTH:
+            start = month_start
+            end = month_start + dateutil.relativedelta.relativedelta(months=1)
+        elif self == Timeframe.THIS_YEAR:
+            start = year_start
+            end = year_start + dateutil.relativedelta.relativedelta(years=1)
+        elif self == Timeframe.YESTERDAY:
+            start, end = today - datetime.timedelta(days=1), today
+        elif self == Timeframe.LAST_WEEK:
+            start, end = week_start - datetime.timedelta(weeks=1), week_start
+        elif self == Timeframe.LAST_MONTH:
+            start = month_start - dateutil.relativedelta.relativedelta(months=1)
+            end = month_start
+        elif self == Timeframe.LAST_YEAR:
+            start = year_start - dateutil.relativedelta.relativedelta(years=1)
+            end = year_start
+
+        return (
+            int(datetime.datetime.combine(start, datetime.time()).timestamp()),
+            int(datetime.datetime.combine(end, datetime.time()).timestamp()),
+        )
+
 
 class DataclassEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -146,656 +298,2711 @@ class DataclassEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
-def strip_quotes(string: str) -> str:
-    return string.replace('"', "")
-
+# The epoch of the local midnight starting the day of an epoch, matching
+# `local_day`
+LOCAL_DAY_SQL = (
+    "CAST(strftime('%s', date({epoch}, 'unixepoch', 'localtime'), 'utc') AS INTEGER)"
+)
 
-def remove_null(null_filled: list) -> list:
-    return [item for item in null_filled if item]
 
+class ScrobbleStore:
+    """
+    Persistent per-user scrobble history, used to only retrieve scrobbles
+    newer than the last stored one
+    """
+
+    def __init__(self, username: str):
+        self.connection = sqlite3.connect(f"analyzer_scrobbles_{username}.sqlite")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS scrobbles (
+                epoch_started INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                mbid TEXT,
+                artist TEXT NOT NULL,
+                artist_mbid TEXT,
+                album TEXT,
+                album_mbid TEXT,
+                PRIMARY KEY (epoch_started, name, artist)
+            )
+            """
+        )
+        # Plays per track (and album) per local day, kept up to date by a
+        # trigger, so timeframes are answered from day buckets instead of
+        # every scrobble
+        has_daily_plays = self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'daily_plays'"
+        ).fetchone()
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS daily_plays (
+                day INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                artist TEXT NOT NULL,
+                album TEXT NOT NULL,
+                mbid TEXT,
+                plays INTEGER NOT NULL,
+                first_played INTEGER NOT NULL,
+                PRIMARY KEY (day, name, artist, album)
+            )
+            """
+        )
+        self.connection.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS scrobbles_daily_plays
+            AFTER INSERT ON scrobbles
+            BEGIN
+                INSERT INTO daily_plays VALUES (
+                    {LOCAL_DAY_SQL.format(epoch="NEW.epoch_started")},
+                    NEW.name,
+                    NEW.artist,
+                    COALESCE(NEW.album, ''),
+                    NEW.mbid,
+                    1,
+                    NEW.epoch_started
+                )
+                ON CONFLICT (day, name, artist, album) DO UPDATE SET
+                    plays = plays + 1,
+                    first_played = MIN(first_played, excluded.first_played);
+            END
+            """
+        )
+        if not has_daily_plays:
+            with self.connection:
+                self.connection.execute(
+                    f"""
+                    INSERT INTO daily_plays
+                    SELECT
+                        {LOCAL_DAY_SQL.format(epoch="epoch_started")} AS day,
+                        name,
+                        artist,
+                        COALESCE(album, '') AS album,
+                        MAX(mbid),
+                        COUNT(*),
+                        MIN(epoch_started)
+                    FROM scrobbles
+                    GROUP BY day, name, artist, COALESCE(album, '')
+                    """
+                )
 
-def last_sunday(d: datetime.date) -> datetime.date:
-    # 0 - Sunday
-    target_day = 0
-    delta_day = target_day - d.isoweekday()
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS coverage (
+                synced_from INTEGER NOT NULL,
+                synced_to INTEGER NOT NULL
+            )
+            """
+        )
+        # The range of scrobbles each history export holds, so exports that
+        # missed syncs made without them are rewritten
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS exports (
+                format TEXT PRIMARY KEY,
+                synced_from INTEGER NOT NULL,
+                synced_to INTEGER NOT NULL
+            )
+            """
+        )
+        # The latest analysis of each timeframe, along with the window and
+        # the newest scrobble it was made with
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS analyses (
+                timeframe TEXT NOT NULL,
+                options TEXT NOT NULL,
+                start INTEGER NOT NULL,
+                end INTEGER NOT NULL,
+                latest_epoch INTEGER NOT NULL,
+                analysis TEXT NOT NULL,
+                PRIMARY KEY (timeframe, options)
+            )
+            """
+        )
 
-    if delta_day >= 0:
-        delta_day -= 7
+    def latest_epoch(self) -> typing.Union[int, None]:
+        return self.connection.execute(
+            "SELECT MAX(epoch_started) FROM scrobbles"
+        ).fetchone()[0]
 
-    return d + datetime.timedelta(days=delta_day)
+    def coverage(self) -> typing.Union[typing.Tuple[int, int], None]:
+        """
+        Returns the inclusive `(from, to)` range of epoch timestamps the store
+        holds every scrobble for, or `None` if nothing was synced yet
+        """
 
+        coverage = self.connection.execute(
+            "SELECT synced_from, synced_to FROM coverage"
+        ).fetchone()
+        if coverage:
+            return coverage
 
-def value_counter(values: list, output: bool = False) -> list:
-    value_counts: dict = {}
-    value_counter = collections.Counter(values)
+        # Stores synced before the coverage was recorded hold the full history
+        latest_epoch = self.latest_epoch()
+        if latest_epoch is not None:
+            return (0, latest_epoch)
 
-    for value, occurrences in value_counter.most_common():
-        if occurrences in value_counts:
-            value_counts[occurrences].append(value)
-        else:
-            value_counts[occurrences] = [value]
+        return None
 
-    if output:
-        print(value_counts)
+    def replace(
+        self,
+        tracks: typing.List[RecentTrack],
+        coverage: typing.Tuple[int, int],
+        full: bool = False,
+    ) -> int:
+        """
+        Store the given scrobbles and the range they cover in a single
+        transaction, removing all existing scrobbles (and the analyses made
+        from them) first if `full` is set.
+        Returns the number of new scrobbles.
+        """
+
+        with self.connection:
+            if full:
+                self.connection.execute("DELETE FROM scrobbles")
+                self.connection.execute("DELETE FROM daily_plays")
+                self.connection.execute("DELETE FROM analyses")
+
+            self.connection.execute("DELETE FROM coverage")
+            self.connection.execute("INSERT INTO coverage VALUES (?, ?)", coverage)
+
+            cursor = self.connection.executemany(
+                "INSERT OR IGNORE INTO scrobbles VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        track.epoch_started,
+                        track.name,
+                        track.mbid,
+                        track.artist.name,
+                        track.artist.mbid,
+                        track.album.name if track.album else None,
+                        track.album.mbid if track.album else None,
+                    )
+                    for track in tracks
+                    if not track.now_playing
+                ),
+            )
 
-    if value_counts:
-        return value_counts[max(value_counts)]
-    else:
-        return []
+            # Unlike the connection's total changes, this leaves out the rows
+            # the daily plays trigger changes
+            return cursor.rowcount
+
+    def load(
+        self, start: int = 0, end: typing.Union[int, None] = None
+    ) -> typing.List[RecentTrack]:
+        """Returns the stored scrobbles in `[start, end)`, newest first"""
+
+        return [
+            RecentTrack(
+                name,
+                mbid,
+                Artist(artist, artist_mbid),
+                Album(album, album_mbid) if album is not None else None,
+                False,
+                epoch_started,
+            )
+            for (
+                epoch_started,
+                name,
+                mbid,
+                artist,
+                artist_mbid,
+                album,
+                album_mbid,
+            ) in self.connection.execute(
+                "SELECT * FROM scrobbles WHERE epoch_started >= ? AND epoch_started < ?"
+                " ORDER BY epoch_started DESC",
+                (start, end if end is not None else 2**63 - 1),
+            )
+        ]
 
+    def load_columns(
+        self, start: int = 0, end: typing.Union[int, None] = None
+    ) -> "ScrobbleColumns":
+        """Returns the stored scrobbles in `[start, end)` as columns, oldest first"""
 
-def get_duration(track: RecentTrack, unique_track_info: typing.List[TrackInfo]) -> int:
-    durations = [
-        unique_track.duration
-        for unique_track in unique_track_info
-        if unique_track.name == track.name and unique_track.artist == track.artist
-    ]
+        columns = ScrobbleColumns()
+        for epoch_started, name, artist, album in self.connection.execute(
+            "SELECT epoch_started, name, artist, album FROM scrobbles"
+            " WHERE epoch_started >= ? AND epoch_started < ? ORDER BY epoch_started",
+            (start, end if end is not None else 2**63 - 1),
+        ):
+            columns.append(name, artist, album, epoch_started)
+
+        return columns
+
+    def load_daily_plays(
+        self, start: int = 0, end: typing.Union[int, None] = None
+    ) -> "ScrobbleColumns":
+        """
+        Returns the daily play counts in `[start, end)` as columns, with the
+        start of the day as the epoch. The bounds must fall on local days.
+        """
+
+        # Ordering by the first play of each day interns tracks, artists,
+        # and albums in the same order as loading every scrobble would
+        columns = ScrobbleColumns()
+        for day, name, artist, album, plays in self.connection.execute(
+            "SELECT day, name, artist, album, plays FROM daily_plays"
+            " WHERE day >= ? AND day < ? ORDER BY day, first_played",
+            (start, end if end is not None else 2**63 - 1),
+        ):
+            columns.append(name, artist, album, day, plays=plays)
 
-    if len(durations) != 0:
-        return durations[0]
+        return columns
 
-    return 0
+    def load_unique_tracks(
+        self, start: int = 0, end: typing.Union[int, None] = None
+    ) -> typing.List[RecentTrack]:
+        """
+        Returns the first scrobble of every track played in `[start, end)`,
+        from the daily play counts. The bounds must fall on local days.
+        """
 
+        return [
+            RecentTrack(
+                name, mbid, Artist(artist, ""), Album(album, ""), False, first_played
+            )
+            for name, mbid, artist, album, first_played in self.connection.execute(
+                "SELECT name, mbid, artist, album, MIN(first_played) FROM daily_plays"
+                " WHERE day >= ? AND day < ? GROUP BY name, artist",
+                (start, end if end is not None else 2**63 - 1),
+            )
+        ]
 
-def join_strings(strings: typing.List[str]) -> str:
-    if len(strings) > 2:
-        return ", ".join(strings[:-1]) + ", and " + str(strings[-1])
-    elif len(strings) == 2:
-        return " and ".join(strings)
-    elif len(strings) == 1:
-        return strings[0]
+    def export_rows(self) -> typing.Iterator[typing.Tuple[str, str, str, int]]:
+        """Streams every stored scrobble as a history export row, oldest first"""
 
+        return self.connection.execute(
+            "SELECT name, artist, COALESCE(album, ''), epoch_started FROM scrobbles"
+            " ORDER BY epoch_started"
+        )
 
-def basic_pluralize(word: str, count: int) -> str:
-    if count != 1:
-        return word + "s"
+    def export_coverage(
+        self, format: str
+    ) -> typing.Union[typing.Tuple[int, int], None]:
+        """Returns the coverage the store had when the export was last written"""
+
+        return self.connection.execute(
+            "SELECT synced_from, synced_to FROM exports WHERE format = ?", (format,)
+        ).fetchone()
+
+    def set_export_coverage(self, format: str) -> None:
+        coverage = self.coverage()
+        with self.connection:
+            if coverage is None:
+                self.connection.execute(
+                    "DELETE FROM exports WHERE format = ?", (format,)
+                )
+            else:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO exports VALUES (?, ?, ?)",
+                    (format, *coverage),
+                )
 
-    return word
+    def load_analysis(
+        self,
+        timeframe: "Timeframe",
+        options: str,
+        bounds: typing.Tuple[int, int],
+        latest_epoch: int,
+    ) -> typing.Union[dict, None]:
+        """
+        Returns the stored analysis of the timeframe, if it was made with the
+        same options and window while `latest_epoch` was the newest scrobble
+        """
+
+        row = self.connection.execute(
+            "SELECT analysis FROM analyses WHERE timeframe = ? AND options = ?"
+            " AND start = ? AND end = ? AND latest_epoch = ?",
+            (timeframe.name, options, *bounds, latest_epoch),
+        ).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def save_analysis(
+        self,
+        timeframe: "Timeframe",
+        options: str,
+        bounds: typing.Tuple[int, int],
+        latest_epoch: int,
+        analysis: dict,
+    ) -> None:
+        """Stores the analysis, replacing the timeframe's previous one"""
+
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO analyses VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    timeframe.name,
+                    options,
+                    *bounds,
+                    latest_epoch,
+                    json.dumps(analysis),
+                ),
+            )
 
+    def close(self) -> None:
+        self.connection.close()
 
-async def async_http_get(
-    url: str, headers: dict = {}, params: dict = {}
-) -> typing.Union[CachedHTTPResponse, None]:
-    global ASYNC_CACHEs
 
-    async with aiohttp_client_cache.CachedSession(cache=ASYNC_CACHE) as session:
-        try:
-            async with session.get(url, headers=headers, params=params) as response:
-                if response.ok and response.text != "":
-                    if not response.is_expired:
-                        return CachedHTTPResponse(
-                            await response.json(), response.from_cache
-                        )
-                    else:
-                        print(f"Expired response ({url})")
-                        await session.delete_expired_responses()
-                        return await async_http_get(url, headers, params)
-                else:
-                    return None
-        except Exception as e:
-            print(f"URL: {url}")
-            print(f"Headers: {headers}")
-            print(f"Parameters: {params}")
-            print(f"Error: {e}")
+class HistoryExporter:
+    """
+    Exports a user's scrobble history, oldest first, to `tracks_[username].csv`
+    or to a Parquet dataset in `tracks_[username].parquet`. Scrobbles are
+    written to a pending file as their pages arrive, then appended to the
+    export once the sync succeeds, so exports kept up to date are never
+    rewritten.
+    """
 
-            return None
+    COLUMNS = ["trackName", "artistName", "albumName", "nowPlaying", "epochStarted"]
+    # Rows written to Parquet at a time
+    BATCH_SIZE = 50000
 
+    def __init__(self, username: str, parquet: bool = False):
+        if parquet and pyarrow is None:
+            termcolor.cprint(
+                "Parquet exports need pyarrow, exporting to CSV instead", "yellow"
+            )
+            parquet = False
+        elif parquet:
+            importlib.import_module("pyarrow.parquet")
+
+        self.parquet = parquet
+        self.rows: typing.List[typing.Tuple[str, str, str, bool, int]] = []
+        self.pending_file: typing.Union[typing.TextIO, None] = None
+        self.pending_writer: typing.Any = None
+
+        if parquet:
+            self.path = f"tracks_{username}.parquet"
+            os.makedirs(self.path, exist_ok=True)
+            # Files starting with an underscore aren't part of the dataset
+            self.pending_path = os.path.join(self.path, "_pending.parquet")
+        else:
+            self.path = f"tracks_{username}.csv"
+            self.pending_path = f"{self.path}.pending"
 
-async def lastfm_aget(payload: dict) -> typing.Union[aiohttp.ClientResponse, None]:
-    global ASYNC_CACHE, ASYNC_USER_CACHE, BASE_URL, HEADERS, LAST_FM_API_KEY
+        if os.path.exists(self.pending_path):
+            os.remove(self.pending_path)
 
-    payload["api_key"] = LAST_FM_API_KEY
-    payload["format"] = "json"
+    @staticmethod
+    def schema() -> "pyarrow.Schema":
+        return pyarrow.schema(
+            [
+                ("trackName", pyarrow.string()),
+                ("artistName", pyarrow.string()),
+                ("albumName", pyarrow.string()),
+                ("nowPlaying", pyarrow.bool_()),
+                ("epochStarted", pyarrow.int64()),
+            ]
+        )
 
-    async with aiohttp_client_cache.CachedSession(
-        cache=ASYNC_USER_CACHE if "user" in payload else ASYNC_CACHE
-    ) as session:
-        try:
-            async with session.get(
-                BASE_URL, headers=HEADERS, params=payload
-            ) as response:
-                if response.ok and response.text != "":
-                    if not response.from_cache:
-                        time.sleep(0.5)
+    def table(
+        self, rows: typing.List[typing.Tuple[str, str, str, bool, int]]
+    ) -> "pyarrow.Table":
+        return pyarrow.Table.from_arrays(
+            [
+                pyarrow.array(column, type=field.type)
+                for column, field in zip(zip(*rows), self.schema())
+            ]
+            if rows
+            else [pyarrow.array([], type=field.type) for field in self.schema()],
+            schema=self.schema(),
+        )
 
-                    if not response.is_expired:
-                        return await response.json()
-                    else:
-                        print(f"Expired response ({payload})")
-                        await session.delete_expired_responses()
-                        return await lastfm_aget(payload)
-                else:
-                    return None
-        except Exception as e:
-            print(f"Parameters: {payload}")
-            print(f"Error: {e}")
-            return None
+    @staticmethod
+    def csv_row(row: typing.Tuple[str, str, str, bool, int]) -> tuple:
+        name, artist, album, now_playing, epoch_started = row
+        return (name, artist, album, json.dumps(now_playing), epoch_started)
 
+    def part_files(self) -> typing.List[str]:
+        return sorted(glob.glob(os.path.join(self.path, "part-*.parquet")))
 
-async def clear_work_queue() -> None:
-    global WORK_QUEUE
+    def exists(self) -> bool:
+        return bool(self.part_files()) if self.parquet else os.path.exists(self.path)
 
-    for _ in range(WORK_QUEUE.qsize()):
-        WORK_QUEUE.get_nowait()
-        WORK_QUEUE.task_done()
+    def add(self, tracks: typing.List[RecentTrack]) -> None:
+        for track in tracks:
+            if not track.now_playing:
+                self.write_pending(
+                    (
+                        track.name,
+                        track.artist.name,
+                        track.album.name if track.album else "",
+                        False,
+                        track.epoch_started,
+                    )
+                )
 
+    def write_pending(self, row: typing.Tuple[str, str, str, bool, int]) -> None:
+        if not self.parquet:
+            if self.pending_file is None:
+                self.pending_file = open(self.pending_path, "w", newline="")
+                self.pending_writer = csv.writer(self.pending_file)
 
-async def get_recent_tracks_page(
-    page: int, output: bool = False
-) -> typing.Union[list, None]:
-    global USERNAME, ERROR
+            self.pending_writer.writerow(self.csv_row(row))
+            return
 
-    if output:
-        print(f"[GRTP] Retrieving page {page}...")
+        self.rows.append(row)
+        if len(self.rows) >= self.BATCH_SIZE:
+            self.flush_pending()
 
-    recent_tracks = await lastfm_aget(
-        {"method": "user.getRecentTracks", "user": USERNAME, "page": page}
-    )
+    def flush_pending(self) -> None:
+        if not self.rows:
+            return
 
-    if recent_tracks:
-        if "error" in recent_tracks and recent_tracks["error"] == 29:
-            await clear_work_queue()
-            ERROR = "Rate limit exceeded"
-            return None
+        if self.pending_writer is None:
+            self.pending_writer = pyarrow.parquet.ParquetWriter(
+                self.pending_path, self.schema()
+            )
 
-    return recent_tracks
+        self.pending_writer.write_table(self.table(self.rows))
+        self.rows = []
+
+    def close_pending(self) -> None:
+        if self.parquet:
+            self.flush_pending()
+            if self.pending_writer is not None:
+                self.pending_writer.close()
+        elif self.pending_file is not None:
+            self.pending_file.close()
+
+        self.pending_file = None
+        self.pending_writer = None
+
+    def discard(self) -> None:
+        self.close_pending()
+        if os.path.exists(self.pending_path):
+            os.remove(self.pending_path)
+
+    def commit(
+        self,
+        store: ScrobbleStore,
+        append: bool,
+        previous_coverage: typing.Union[typing.Tuple[int, int], None],
+    ) -> None:
+        """
+        Appends the pending scrobbles to the export if `append` is set and
+        the export holds everything the store covered before the sync
+        (`previous_coverage`), otherwise rewrites it from the store
+        """
+
+        self.close_pending()
+
+        format = "parquet" if self.parquet else "csv"
+        if (
+            append
+            and previous_coverage is not None
+            and self.exists()
+            and store.export_coverage(format) == tuple(previous_coverage)
+        ):
+            if os.path.exists(self.pending_path):
+                self.append_pending()
+        else:
+            self.rewrite(store)
 
+        store.set_export_coverage(format)
 
-async def get_track_info(
-    track: BasicTrackInfo, output: bool = False
-) -> typing.Union[TrackInfo, None]:
-    global ERROR
+        if os.path.exists(self.pending_path):
+            os.remove(self.pending_path)
 
-    if output:
-        print(f"[GTIS] {track.name} ({track.artist})")
+    def append_pending(self) -> None:
+        # Pages arrive in any order, but only hold the newly synced scrobbles
+        if self.parquet:
+            table = pyarrow.parquet.read_table(self.pending_path).sort_by(
+                "epochStarted"
+            )
+            if table.num_rows:
+                pyarrow.parquet.write_table(
+                    table,
+                    os.path.join(
+                        self.path,
+                        f"part-{table['epochStarted'][0].as_py():012d}.parquet",
+                    ),
+                )
+            return
 
-    track_info_request = await lastfm_aget(
-        {
-            "method": "track.getInfo",
-            "track": track.name,
-            "artist": track.artist,
-        }
-    )
+        with open(self.pending_path, newline="") as pending_file:
+            rows = sorted(csv.reader(pending_file), key=lambda row: int(row[4]))
 
-    if track_info_request:
-        if "error" in track_info_request and track_info_request["error"] == 29:
-            await clear_work_queue()
-            print("RLE")
-            ERROR = "Rate limit exceeded"
-            return None
+        with open(self.path, "a", newline="") as export_file:
+            csv.writer(export_file).writerows(rows)
 
-        try:
-            track_info = track_info_request["track"]
-            return TrackInfo(
-                track_info["name"],
-                track.mbid,
-                Artist(
-                    track_info["artist"]["name"],
-                    track_info["artist"].get("mbid", ""),
-                ),
-                Album(track_info["album"]["title"], "")
-                if "album" in track_info
-                else None,
-                int(track_info["duration"]),
-                int(track_info["playcount"]),
-            )
-        except Exception as e:
-            print(e)
-            print(type(track_info_request))
-            print(track_info_request)
+    def rewrite(self, store: ScrobbleStore) -> None:
+        rows = (
+            (name, artist, album, False, epoch_started)
+            for name, artist, album, epoch_started in store.export_rows()
+        )
 
-            return None
-    else:
-        return None
+        if self.parquet:
+            for part_file in self.part_files():
+                os.remove(part_file)
 
+            writer = pyarrow.parquet.ParquetWriter(
+                os.path.join(self.path, "part-000000000000.parquet"), self.schema()
+            )
+            for batch in iter(
+                lambda: list(itertools.islice(rows, self.BATCH_SIZE)), []
+            ):
+                writer.write_table(self.table(batch))
+            writer.close()
+            return
+
+        # Written next to the export and moved over it, so it's never partial
+        with open(f"{self.path}.tmp", "w", newline="") as export_file:
+            writer = csv.writer(export_file)
+            writer.writerow(self.COLUMNS)
+            writer.writerows(self.csv_row(row) for row in rows)
+
+        os.replace(f"{self.path}.tmp", self.path)
+
+
+class MetadataStore:
+    """
+    Persistent track metadata shared by every user, mapping a normalized
+    (artist, track, mbid) to the resolved duration and where it came from.
+    Tracks without a duration anywhere are remembered as misses.
+    """
+
+    def __init__(self, ttls: typing.Dict[str, int] = METADATA_TTLS):
+        self.ttls = ttls
+        self.pending: typing.List[tuple] = []
+        self.connection = sqlite3.connect("analyzer_metadata.sqlite", timeout=30)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS track_metadata (
+                artist TEXT NOT NULL,
+                track TEXT NOT NULL,
+                mbid TEXT NOT NULL,
+                name TEXT NOT NULL,
+                artist_name TEXT NOT NULL,
+                artist_mbid TEXT,
+                album TEXT,
+                duration INTEGER NOT NULL,
+                source TEXT NOT NULL,
+                expires_at INTEGER NOT NULL,
+                spotify_id TEXT,
+                PRIMARY KEY (artist, track, mbid)
+            )
+            """
+        )
 
-async def find_track(
-    search_track: BasicTrackInfo, output: bool = False
-) -> typing.Union[typing.Tuple[dict, BasicTrackInfo], None]:
-    global SPOTIFY_ACCESS_TOKEN
+        # Stores created before Spotify ids were kept don't have the column
+        if "spotify_id" not in [
+            column[1]
+            for column in self.connection.execute("PRAGMA table_info(track_metadata)")
+        ]:
+            self.connection.execute(
+                "ALTER TABLE track_metadata ADD COLUMN spotify_id TEXT"
+            )
 
-    request = await async_http_get(
-        "https://api.spotify.com/v1/search",
-        headers={
-            "Authorization": f"Bearer {SPOTIFY_ACCESS_TOKEN}",
-            "Content-Type": "application/json",
-        },
-        params={"q": f"track:{search_track.name}", "type": "track", "limit": 5},
-    )
-    if request:
-        tracks = request.response["tracks"]["items"]
-        if len(tracks) != 0:
-            for track in tracks:
-                if output:
-                    print(
-                        f"{track['name']} ({', '.join([artist['name'] for artist in remove_null(track['artists'])])})"
-                    )
+    @staticmethod
+    def key(track: BasicTrackInfo) -> typing.Tuple[str, str, str]:
+        return (normalize(track.artist), normalize(track.name), track.mbid or "")
+
+    def get(
+        self, track: BasicTrackInfo
+    ) -> typing.Union[typing.Tuple[TrackInfo, str], None]:
+        """Returns the unexpired track information and its source, if stored"""
+
+        metadata = self.connection.execute(
+            """
+            SELECT name, artist_name, artist_mbid, album, duration, source
+            FROM track_metadata
+            WHERE artist = ? AND track = ? AND mbid = ? AND expires_at > ?
+            """,
+            (*self.key(track), int(time.time())),
+        ).fetchone()
+        if not metadata:
+            return None
 
-                if track[
-                    "name"
-                ].lower() == search_track.name.lower() and search_track.artist.lower() in [
-                    artist["name"].lower() for artist in remove_null(track["artists"])
-                ]:
-                    return (track, search_track)
+        name, artist_name, artist_mbid, album, duration, source = metadata
+        return (
+            TrackInfo(
+                name,
+                track.mbid,
+                Artist(artist_name, artist_mbid),
+                Album(album, "") if album is not None else None,
+                duration,
+                0,
+            ),
+            source,
+        )
 
+    def get_spotify(
+        self, track: BasicTrackInfo
+    ) -> typing.Union[typing.Tuple[TrackInfo, str], None]:
+        """
+        Returns the track information and Spotify id of a track resolved
+        through Spotify, even if expired, so it can be refreshed by id
+        """
+
+        metadata = self.connection.execute(
+            """
+            SELECT name, artist_name, artist_mbid, album, duration, spotify_id
+            FROM track_metadata
+            WHERE artist = ? AND track = ? AND mbid = ? AND spotify_id IS NOT NULL
+            """,
+            self.key(track),
+        ).fetchone()
+        if not metadata:
             return None
-        else:
-            return None
-    else:
-        return None
 
+        name, artist_name, artist_mbid, album, duration, spotify_id = metadata
+        return (
+            TrackInfo(
+                name,
+                track.mbid,
+                Artist(artist_name, artist_mbid),
+                Album(album, "") if album is not None else None,
+                duration,
+                0,
+            ),
+            spotify_id,
+        )
 
-async def get_musicbrainz_duration(
-    search_track: BasicTrackInfo, output: bool = False
-) -> typing.Union[typing.Tuple[int, BasicTrackInfo], None]:
-    global HEADERS
+    def put(
+        self,
+        track: BasicTrackInfo,
+        track_info: TrackInfo,
+        source: str,
+        spotify_id: typing.Union[str, None] = None,
+    ) -> None:
+        # Writes are batched until the next flush
+        self.pending.append(
+            (
+                *self.key(track),
+                track_info.name,
+                track_info.artist.name,
+                track_info.artist.mbid,
+                track_info.album.name if track_info.album else None,
+                track_info.duration,
+                source,
+                int(time.time()) + self.ttls[source],
+                spotify_id,
+            )
+        )
 
-    if output:
-        print(search_track)
+    def flush(self) -> None:
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO track_metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                self.pending,
+            )
 
-    response = await async_http_get(
-        "https://musicbrainz.org/ws/2/recording",
-        headers=HEADERS,
-        params={
-            "query": f"{search_track.name} artist:{search_track.artist}",
-            "fmt": "json",
-        },
-    )
+        self.pending.clear()
 
-    if response:
-        results = response.response["recordings"]
-        if len(results) > 0:
-            for result in results:
-                if result["title"].replace(
-                    "\u2019", "'"
-                ).lower() != search_track.name.lower() or search_track.artist.lower() not in [
-                    artist["name"].lower() for artist in result["artist-credit"]
-                ]:
-                    continue
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
 
-                if search_track.mbid != "":
-                    if output:
-                        print("[GMBD] MBID provided, checking for matches...")
 
-                    for release in result["releases"]:
-                        for medium in release["media"]:
-                            for track_list in medium["track"]:
-                                if track_list["id"] == search_track.mbid:
-                                    if output:
-                                        print("[GMBD] MBID match")
+class TrackCatalog:
+    """
+    Resolved track information, indexed by the scrobbled track name and
+    artist, so scrobbles are joined to their duration in constant time
+    """
 
-                                    try:
-                                        return (int(result["length"]), search_track)
-                                    except Exception as error:
-                                        print(f"[GMBD] {error}")
-                                        return None
+    def __init__(self):
+        self.tracks: typing.Dict[typing.Tuple[str, str], TrackInfo] = {}
 
-                    return None
-                else:
-                    if output:
-                        print("[GMBD] No MBID provided")
+    @staticmethod
+    def key(name: str, artist: str) -> typing.Tuple[str, str]:
+        return (normalize(name), normalize(artist))
 
-                    try:
-                        return (int(result["length"]), search_track)
-                    except Exception as error:
-                        print(f"[GMBD] Error: {error}")
-                        return None
+    def __contains__(self, key: typing.Tuple[str, str]) -> bool:
+        return key in self.tracks
 
-            return None
+    def __len__(self) -> int:
+        return len(self.tracks)
 
-        return None
+    def get(self, key: typing.Tuple[str, str]) -> typing.Union[TrackInfo, None]:
+        return self.tracks.get(key)
 
-    return None
+    def set(self, key: typing.Tuple[str, str], track_info: TrackInfo) -> None:
+        self.tracks[key] = track_info
 
+    def set_duration(self, key: typing.Tuple[str, str], duration: int) -> None:
+        self.tracks[key].duration = duration
 
-async def worker(
-    name: str,
-    executable: typing.Callable,
-    output: bool = False,
-):
-    global WORK_QUEUE, WORK_QUEUE_OUTPUT
 
-    if output:
-        print(f"[WORKER::{name}] Started")
+class StringInterner:
+    """Maps values to dense integer ids and back, so columns only hold ids"""
 
-    while not WORK_QUEUE.empty():
-        item = await WORK_QUEUE.get()
+    def __init__(self):
+        self.ids: typing.Dict[typing.Hashable, int] = {}
+        self.values: typing.List[typing.Hashable] = []
 
-        if output:
-            print(f"[WORKER::{name}] {WORK_QUEUE.qsize()} items left")
+    def intern(self, value: typing.Hashable) -> int:
+        id = self.ids.get(value)
+        if id is None:
+            id = self.ids[value] = len(self.values)
+            self.values.append(value)
 
-        WORK_QUEUE_OUTPUT.append(await executable(item, output))
+        return id
 
+    def __getitem__(self, id: int) -> typing.Hashable:
+        return self.values[id]
 
-async def start_workers(
-    worker_prefix: str,
-    executable: typing.Callable,
-    clear_work_queue_output: bool = True,
-    worker_count: int = 5,
-    output: bool = False,
-) -> None:
-    global WORK_QUEUE_OUTPUT
+    def __len__(self) -> int:
+        return len(self.values)
 
-    if clear_work_queue_output:
-        WORK_QUEUE_OUTPUT.clear()
 
-    await asyncio.gather(
-        *[
-            worker(f"{worker_prefix}.{worker_index}", executable, output)
-            for worker_index in range(worker_count)
-        ],
-    )
+class ScrobbleColumns:
+    """
+    Scrobble history stored column by column: interned track, artist, and
+    album ids next to int64 start epochs, int32 durations, and int32 play
+    counts, sorted by start epoch. Albums are `-1` for scrobbles without one.
+    Rows are either single scrobbles or a track's plays on a day.
+    """
 
+    def __init__(
+        self,
+        tracks: typing.Union[StringInterner, None] = None,
+        artists: typing.Union[StringInterner, None] = None,
+        albums: typing.Union[StringInterner, None] = None,
+    ):
+        # Tracks are interned as (name, artist) pairs, so tracks sharing a
+        # name across artists are counted separately
+        self.tracks = tracks or StringInterner()
+        self.artists = artists or StringInterner()
+        self.albums = albums or StringInterner()
 
-async def get_unique_tracks(
-    tracks: typing.List[RecentTrack],
-) -> typing.Union[
-    typing.Tuple[typing.List[typing.Set[BasicTrackInfo]], typing.List[TrackInfo]],
-    None,
-]:
-    global WORK_QUEUE_OUTPUT, WORK_QUEUE, SPOTIFY_ACCESS_TOKEN, OUTPUT
+        self.track_ids = array.array("i")
+        self.artist_ids = array.array("i")
+        self.album_ids = array.array("i")
+        self.epochs = array.array("q")
+        self.durations = array.array("i")
+        self.plays = array.array("i")
 
-    unique_tracks: typing.List[typing.Set[BasicTrackInfo]] = list(
-        set(
-            [
-                BasicTrackInfo(
+    @classmethod
+    def from_tracks(cls, tracks: typing.Iterable[RecentTrack]) -> "ScrobbleColumns":
+        columns = cls()
+        for track in sorted(tracks, key=lambda track: track.epoch_started):
+            if not track.now_playing:
+                columns.append(
                     track.name,
                     track.artist.name,
                     track.album.name if track.album else None,
-                    track.mbid,
+                    track.epoch_started,
                 )
-                for track in tracks
-            ]
+
+        return columns
+
+    def __len__(self) -> int:
+        return len(self.epochs)
+
+    def play_count(self) -> int:
+        return int(numpy.frombuffer(self.plays, dtype=numpy.int32).sum())
+
+    def append(
+        self,
+        name: str,
+        artist: str,
+        album: typing.Union[str, None],
+        epoch_started: int,
+        duration: int = 0,
+        plays: int = 1,
+    ) -> None:
+        self.track_ids.append(self.tracks.intern((name, artist)))
+        self.artist_ids.append(self.artists.intern(artist))
+        self.album_ids.append(self.albums.intern(album) if album is not None else -1)
+        self.epochs.append(epoch_started)
+        self.durations.append(duration)
+        self.plays.append(plays)
+
+    def between(
+        self, start: int = 0, end: typing.Union[int, None] = None
+    ) -> "ScrobbleColumns":
+        """
+        Returns the scrobbles in `[start, end)`, found by binary search and
+        sharing this history's interned values
+        """
+
+        low = bisect.bisect_left(self.epochs, start)
+        high = len(self) if end is None else bisect.bisect_left(self.epochs, end)
+
+        columns = ScrobbleColumns(self.tracks, self.artists, self.albums)
+        columns.track_ids = self.track_ids[low:high]
+        columns.artist_ids = self.artist_ids[low:high]
+        columns.album_ids = self.album_ids[low:high]
+        columns.epochs = self.epochs[low:high]
+        columns.durations = self.durations[low:high]
+        columns.plays = self.plays[low:high]
+
+        return columns
+
+    def set_durations(self, catalog: TrackCatalog) -> None:
+        # Look every unique track up once, then fill the column by id
+        track_durations = []
+        for name, artist in self.tracks.values:
+            track_info = catalog.get(TrackCatalog.key(name, artist))
+            track_durations.append(track_info.duration if track_info else 0)
+
+        self.durations = array.array(
+            "i", [track_durations[track_id] for track_id in self.track_ids]
         )
-    )
 
-    termcolor.cprint("Retrieving unique track information...", attrs=["bold"])
-    for track in unique_tracks:
-        await WORK_QUEUE.put(track)
 
-    await start_workers("GTI", get_track_info, output=OUTPUT)
-    if ERROR:
-        exit(ERROR)
+class SpaceSaving:
+    """
+    Space-Saving heavy hitters: at most `capacity` counters, where a new
+    value takes over the smallest counter. Every kept count overestimates
+    the true count by at most its error (itself at most `total / capacity`),
+    and every value counted more than `total / capacity` times is kept.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.total = 0
+        self.counts: typing.Dict[typing.Hashable, int] = {}
+        self.errors: typing.Dict[typing.Hashable, int] = {}
+
+        # Entries are invalidated lazily, by comparing them to the counts
+        self.heap: typing.List[typing.Tuple[int, int, typing.Hashable]] = []
+        self.order = itertools.count()
+
+    def add(self, value: typing.Hashable, count: int = 1) -> None:
+        self.total += count
+
+        if value in self.counts:
+            self.counts[value] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[value] = count
+            self.errors[value] = 0
+        else:
+            minimum, evicted = self.pop_minimum()
+            del self.counts[evicted], self.errors[evicted]
+            self.counts[value] = minimum + count
+            self.errors[value] = minimum
 
-    unique_track_info: typing.List[TrackInfo] = remove_null(WORK_QUEUE_OUTPUT)
+        heapq.heappush(self.heap, (self.counts[value], next(self.order), value))
+        if len(self.heap) > 4 * self.capacity:
+            self.rebuild_heap()
 
-    print()
+    def pop_minimum(self) -> typing.Tuple[int, typing.Hashable]:
+        while True:
+            count, _, value = heapq.heappop(self.heap)
+            if self.counts.get(value) == count:
+                return (count, value)
 
-    no_duration_tracks: typing.List[TrackInfo] = [
-        track for track in unique_track_info if track.duration == 0
-    ]
-    print(f"Tracks with no duration: {len(no_duration_tracks)}")
+    def minimum(self) -> int:
+        """The count every value that isn't kept may have been counted up to"""
 
-    if len(no_duration_tracks) != 0:
-        if SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET:
-            async with asyncspotify.Client(
-                asyncspotify.ClientCredentialsFlow(
-                    SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET
-                )
-            ) as sp:
-                SPOTIFY_ACCESS_TOKEN = sp.auth.header["Authorization"].split(" ")[1]
+        if len(self.counts) < self.capacity:
+            return 0
 
-            termcolor.cprint(
-                "Retrieving durations for no duration tracks (Spotify)...",
-                attrs=["bold"],
-            )
-            for track in no_duration_tracks:
-                album_name: typing.Union[str, None] = (
-                    track.album.name if track.album else None
+        while self.counts.get(self.heap[0][2]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+        return self.heap[0][0]
+
+    def rebuild_heap(self) -> None:
+        self.heap = [
+            (count, next(self.order), value) for value, count in self.counts.items()
+        ]
+        heapq.heapify(self.heap)
+
+    def merge(self, other: "SpaceSaving") -> None:
+        """
+        Merges another sketch's counts in, values missing from either side
+        counting as (and erring by) that side's minimum, keeping the bounds
+        """
+
+        minimum, other_minimum = self.minimum(), other.minimum()
+
+        counts: typing.Dict[typing.Hashable, int] = {}
+        errors: typing.Dict[typing.Hashable, int] = {}
+        for value in itertools.chain(self.counts, other.counts):
+            if value not in counts:
+                counts[value] = self.counts.get(value, minimum) + other.counts.get(
+                    value, other_minimum
                 )
-                if not album_name:
-                    og_track: typing.List[RecentTrack] = [
-                        _track
-                        for _track in tracks
-                        if _track.name == track.name and _track.artist == track.artist
-                    ]
-
-                    if len(og_track) > 0 and og_track[0].album:
-                        album_name: str = og_track[0].album.name
-
-                await WORK_QUEUE.put(
-                    BasicTrackInfo(
-                        track.name, track.artist.name, album_name, track.mbid
-                    )
+                errors[value] = self.errors.get(value, minimum) + other.errors.get(
+                    value, other_minimum
                 )
 
-            await start_workers("SFTD", find_track, output=OUTPUT)
-            if ERROR:
-                exit(ERROR)
+        kept = sorted(counts, key=counts.__getitem__, reverse=True)[: self.capacity]
+        self.counts = {value: counts[value] for value in kept}
+        self.errors = {value: errors[value] for value in kept}
+        self.total += other.total
+        self.rebuild_heap()
+
+
+class CountMinSketch:
+    """
+    Count-Min sketch: a `depth` by `width` table of counters, estimating a
+    value's count as the smallest of its counters. Estimates never
+    undercount, and overcount by at most `e / width` of the total with a
+    probability of `1 - e^-depth`.
+    """
+
+    def __init__(self, width: int = 2048, depth: int = 4):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self.table = numpy.zeros((depth, width), dtype=numpy.int64)
+        self.rows = numpy.arange(depth)
+
+    def indexes(self, value: typing.Hashable) -> typing.List[int]:
+        # A single stable digest (unlike `hash`) split into a counter per row,
+        # so sketches from other processes can be merged
+        digest = hashlib.blake2b(
+            repr(value).encode(), digest_size=4 * self.depth
+        ).digest()
+
+        return [
+            int.from_bytes(digest[4 * row : 4 * (row + 1)], "little") % self.width
+            for row in range(self.depth)
+        ]
 
-            pre_spotify_uti: typing.List[TrackInfo] = [
-                track for track in unique_track_info if track.duration == 0
-            ]
+    def index_table(
+        self, values: "StringInterner", ids: numpy.ndarray
+    ) -> numpy.ndarray:
+        """
+        Returns the counter indexes of interned values as a table indexed by
+        id, only hashing the distinct values in `ids`
+        """
+
+        table = numpy.zeros((len(values), self.depth), dtype=numpy.int64)
+        for id in numpy.unique(ids).tolist():
+            table[id] = self.indexes(values[id])
+
+        return table
+
+    def add(self, value: typing.Hashable, count: int = 1) -> None:
+        self.total += count
+        self.table[self.rows, self.indexes(value)] += count
+
+    def add_ids(
+        self, index_table: numpy.ndarray, ids: numpy.ndarray, counts: numpy.ndarray
+    ) -> None:
+        """Adds a column of ids at once, with their indexes from `index_table`"""
+
+        self.total += int(counts.sum())
+        indexes = index_table[ids]
+        for row in range(self.depth):
+            numpy.add.at(self.table[row], indexes[:, row], counts)
+
+    def estimate(self, value: typing.Hashable) -> int:
+        return int(self.table[self.rows, self.indexes(value)].min())
+
+    def merge(self, other: "CountMinSketch") -> None:
+        self.table += other.table
+        self.total += other.total
+
+
+class HeavyHitters:
+    """
+    Approximate top values in bounded memory: Space-Saving picks the
+    candidates and bounds their counts from below, while a Count-Min sketch
+    tightens them from above. Sketches with the same capacity and
+    dimensions can be merged, e.g. across users.
+    """
+
+    def __init__(self, capacity: int):
+        self.counters = SpaceSaving(capacity)
+        self.sketch = CountMinSketch()
+
+    def add(self, value: typing.Hashable, count: int = 1) -> None:
+        self.counters.add(value, count)
+        self.sketch.add(value, count)
+
+    def add_column(
+        self, values: "StringInterner", ids: array.array, counts: array.array
+    ) -> None:
+        """
+        Adds an integer-coded column of interned values, weighted by
+        `counts`. Negative ids are skipped. Every row goes through
+        Space-Saving, while the Count-Min sketch hashes each distinct value
+        once and takes the whole column in one update.
+        """
+
+        column_ids = numpy.frombuffer(ids, dtype=numpy.int32)
+        column_counts = numpy.frombuffer(counts, dtype=numpy.int32).astype(numpy.int64)
+        mask = column_ids >= 0
+        column_ids, column_counts = column_ids[mask], column_counts[mask]
+
+        for id, count in zip(column_ids.tolist(), column_counts.tolist()):
+            self.counters.add(values[id], count)
+
+        self.sketch.add_ids(
+            self.sketch.index_table(values, column_ids), column_ids, column_counts
+        )
 
-            for output_item in remove_null(WORK_QUEUE_OUTPUT):
-                track, search_track = output_item
-
-                unique_track: typing.List[
-                    typing.Union[typing.List[TrackInfo], TrackInfo]
-                ] = [
-                    track
-                    for track in unique_track_info
-                    if track.name == search_track.name
-                ]
-                if len(unique_track) > 0:
-                    unique_track: TrackInfo = unique_track[0]
-                    unique_track_index: int = unique_track_info.index(unique_track)
-                else:
-                    termcolor.cprint("Unique track not found", "red")
+    def merge(self, other: "HeavyHitters") -> None:
+        self.counters.merge(other.counters)
+        self.sketch.merge(other.sketch)
+
+    def max_error(self) -> int:
+        """
+        The most any count is overestimated by, which is also the most any
+        value that isn't kept may have been counted
+        """
+
+        return self.counters.minimum()
+
+    def top(
+        self, limit: int = 0
+    ) -> typing.List[typing.Tuple[typing.Hashable, int, int]]:
+        """
+        Returns `(value, count, error)` triples, most counted first, where the
+        true count is between `count - error` and `count`. With a `limit`,
+        stops after the `limit`th entry and everything tied with it.
+        """
+
+        top = []
+        for value, count in self.counters.counts.items():
+            estimate = min(count, self.sketch.estimate(value))
+            top.append(
+                (value, estimate, estimate - (count - self.counters.errors[value]))
+            )
+        top.sort(key=lambda entry: entry[1], reverse=True)
+
+        if limit and limit < len(top):
+            cutoff = top[limit - 1][1]
+            top = [entry for entry in top if entry[1] >= cutoff]
+
+        return top
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the requests sent to a backend. Waiting for a token
+    only suspends the waiting coroutine, never the event loop.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.capacity = max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.throttle_events = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        # Waiters queue up on the lock, so tokens are handed out in order
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
                     continue
 
-                unique_track_info[unique_track_index] = dataclasses.replace(
-                    unique_track, duration=int(track["duration_ms"])
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
                 )
+                self.updated = now
 
-            post_spotify_uti: typing.List[TrackInfo] = [
-                track for track in unique_track_info if track.duration == 0
-            ]
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
 
-            print(
-                f"Spotify durations found: {len(pre_spotify_uti) - len(post_spotify_uti)}"
-            )
+                await asyncio.sleep((1 - self.tokens) / self.rate)
 
-        termcolor.cprint(
-            "Retrieving durations for no duration tracks (MusicBrainz)...",
-            attrs=["bold"],
-        )
-        for item in [track for track in unique_track_info if track.duration == 0]:
-            await WORK_QUEUE.put(
-                BasicTrackInfo(
-                    item.name,
-                    item.artist.name,
-                    item.album.name if item.album else None,
-                    item.mbid,
-                )
-            )
+    def throttle(self, delay: float) -> None:
+        """Stop handing out tokens for `delay` seconds after being rate limited"""
 
-        await start_workers("MBD", get_musicbrainz_duration, output=OUTPUT)
-        if ERROR:
-            exit(ERROR)
+        self.throttle_events += 1
+        self.tokens = 0
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
 
-        for output in remove_null(WORK_QUEUE_OUTPUT):
-            duration, search_track = output
+    def trace_config(self) -> aiohttp.TraceConfig:
+        # Cached responses never reach the request hooks, so only requests
+        # that go out over the network spend a token
+        async def on_request_start(session, context, params):
+            await self.acquire()
 
-            unique_track: typing.List[
-                typing.Union[typing.List[TrackInfo], TrackInfo]
-            ] = [
-                track for track in unique_track_info if track.name == search_track.name
-            ]
-            if len(unique_track) > 0:
-                unique_track: TrackInfo = unique_track[0]
-                unique_track_index: int = unique_track_info.index(unique_track)
-            else:
-                termcolor.cprint("Unique track not found", "red")
-                continue
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
 
-            unique_track_info[unique_track_index] = dataclasses.replace(
-                unique_track, duration=duration
-            )
+        return trace_config
 
-        post_duration_uti: typing.List[TrackInfo] = [
-            track for track in unique_track_info if track.duration == 0
+
+class SessionManager:
+    """
+    Owns one pooled session per backend (`lastfm`, `spotify`, `musicbrainz`)
+    and the track cache they share, so connections and the cache handle are
+    reused for the lifetime of a run
+    """
+
+    def __init__(
+        self,
+        limits: typing.Dict[str, int] = CONNECTION_LIMITS,
+        rate_limits: typing.Dict[str, float] = RATE_LIMITS,
+        keepalive_timeout: float = KEEPALIVE_TIMEOUT,
+    ):
+        self.limits = limits
+        self.rate_limiters: typing.Dict[str, RateLimiter] = {
+            backend: RateLimiter(rate) for backend, rate in rate_limits.items()
+        }
+        self.keepalive_timeout = keepalive_timeout
+        self.cache: typing.Union[aiohttp_client_cache.SQLiteBackend, None] = None
+        self.sessions: typing.Dict[str, aiohttp_client_cache.CachedSession] = {}
+
+    def get(self, backend: str) -> aiohttp_client_cache.CachedSession:
+        if not self.cache:
+            # Normal cache expires after a month
+            self.cache = aiohttp_client_cache.SQLiteBackend(
+                cache_name="analyzer_tracks_cache",
+                expire_after=2628000,
+                allowed_methods=("GET", "POST"),
+                allowed_codes=(200,),
+                ignored_params=["api_key"],
+                autoclose=False,
+            )
+
+        # Sessions are created lazily, as they need a running event loop
+        if backend not in self.sessions:
+            self.sessions[backend] = aiohttp_client_cache.CachedSession(
+                cache=self.cache,
+                connector=aiohttp.TCPConnector(
+                    limit_per_host=self.limits.get(backend, 10),
+                    keepalive_timeout=self.keepalive_timeout,
+                ),
+                trace_configs=[self.rate_limiter(backend).trace_config()],
+            )
+
+        return self.sessions[backend]
+
+    def rate_limiter(self, backend: str) -> RateLimiter:
+        if backend not in self.rate_limiters:
+            self.rate_limiters[backend] = RateLimiter(10)
+
+        return self.rate_limiters[backend]
+
+    async def close(self) -> None:
+        for session in self.sessions.values():
+            await session.close()
+
+        self.sessions.clear()
+
+        if self.cache:
+            await self.cache.close()
+            self.cache = None
+
+
+SESSIONS = SessionManager()
+
+
+class SingleFlight:
+    """
+    Merges concurrent work on the same key, so every caller asking for a key
+    while it's in flight shares the result of the first one
+    """
+
+    def __init__(self):
+        self.calls: typing.Dict[typing.Hashable, asyncio.Future] = {}
+
+    async def do(
+        self,
+        key: typing.Hashable,
+        function: typing.Callable[[], typing.Awaitable[typing.Any]],
+    ) -> typing.Any:
+        if key not in self.calls:
+            task = asyncio.ensure_future(function())
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+
+        # A caller going away (e.g. a closed connection) must not cancel the
+        # work the other callers are waiting for
+        return await asyncio.shield(self.calls[key])
+
+    def claim(self, key: typing.Hashable) -> typing.Union[asyncio.Future, None]:
+        """
+        Returns the future of the key if it's in flight, otherwise claims the
+        key for the caller (returning `None`), who then has to `release` it
+        """
+
+        if key in self.calls:
+            return self.calls[key]
+
+        self.calls[key] = asyncio.get_running_loop().create_future()
+        return None
+
+    def release(self, key: typing.Hashable, result: typing.Any = None) -> None:
+        future = self.calls.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+
+# Tracks being resolved by any enricher, so concurrent analyses never look
+# the same track up twice
+TRACK_FLIGHTS = SingleFlight()
+
+
+class RunMetrics:
+    """
+    Counters for a run, by pipeline stage and by backend: time spent, items,
+    failures, requests, cache hits and misses, bytes received, retries, and
+    throttling. Requests are attributed to the stage they're sent from.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.stages: typing.Dict[str, typing.Counter[str]] = collections.defaultdict(
+            collections.Counter
+        )
+        self.backends: typing.Dict[str, typing.Counter[str]] = collections.defaultdict(
+            collections.Counter
+        )
+        self.hosts: typing.Dict[str, str] = {}
+
+    @contextlib.contextmanager
+    def measure(self, stage: str) -> typing.Iterator[None]:
+        """Times the block as `stage`, which requests sent from it count toward"""
+
+        # Stages nested in themselves (e.g. a pipeline stage run from a
+        # function already measured as that stage) are only timed once
+        nested = CURRENT_STAGE.get() == stage
+        token = CURRENT_STAGE.set(stage)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            CURRENT_STAGE.reset(token)
+            if not nested:
+                self.stages[stage]["seconds"] += time.monotonic() - started
+
+    def counters(self, backend: str) -> typing.List[typing.Counter[str]]:
+        stage = CURRENT_STAGE.get()
+        return [self.backends[backend], *([self.stages[stage]] if stage else [])]
+
+    def record_item(self, stage: str, latency: float, failed: bool) -> None:
+        self.stages[stage]["items"] += 1
+        self.stages[stage]["item_seconds"] += latency
+        if failed:
+            self.stages[stage]["failures"] += 1
+
+    def record_response(
+        self, backend: str, url: str, from_cache: bool, size: int
+    ) -> None:
+        self.hosts.setdefault(backend, urllib.parse.urlsplit(url).hostname or "")
+        for counters in self.counters(backend):
+            counters["requests"] += 1
+            counters["cache_hits" if from_cache else "cache_misses"] += 1
+            counters["bytes"] += size
+
+    def record_retry(self, backend: str, throttled: bool) -> None:
+        for counters in self.counters(backend):
+            counters["retries"] += 1
+            if throttled:
+                counters["throttles"] += 1
+
+    def record_error(self, backend: str) -> None:
+        for counters in self.counters(backend):
+            counters["errors"] += 1
+
+    @staticmethod
+    def describe(counters: typing.Counter[str]) -> dict:
+        lookups = counters["cache_hits"] + counters["cache_misses"]
+        return {
+            **counters,
+            "cache_hit_ratio": counters["cache_hits"] / lookups if lookups else None,
+        }
+
+    def summary(self) -> dict:
+        return {
+            "seconds": time.monotonic() - self.started,
+            "stages": {
+                stage: self.describe(counters)
+                for stage, counters in self.stages.items()
+            },
+            "backends": {
+                backend: {"host": self.hosts.get(backend), **self.describe(counters)}
+                for backend, counters in self.backends.items()
+            },
+        }
+
+    def prometheus(self) -> str:
+        """The counters in Prometheus' text exposition format"""
+
+        lines = []
+        for kind, label, groups in (
+            ("stage", "stage", self.stages),
+            ("backend", "backend", self.backends),
+        ):
+            names = sorted({name for counters in groups.values() for name in counters})
+            for name in names:
+                metric = f"acoustats_{kind}_{name}" + (
+                    "" if name.endswith(("seconds", "bytes")) else "_total"
+                )
+                lines.append(f"# TYPE {metric} counter")
+                for group, counters in sorted(groups.items()):
+                    lines.append(
+                        f'{metric}{{{label}="{group}"}} {float(counters[name])!r}'
+                    )
+
+        return "\n".join(lines) + "\n"
+
+
+# The pipeline stage the running code belongs to, if any
+CURRENT_STAGE: contextvars.ContextVar[typing.Union[str, None]] = contextvars.ContextVar(
+    "CURRENT_STAGE", default=None
+)
+METRICS = RunMetrics()
+
+
+def normalize(string: str) -> str:
+    return string.replace("\u2019", "'").casefold().strip()
+
+
+def remove_null(null_filled: list) -> list:
+    return [item for item in null_filled if item]
+
+
+def last_sunday(d: datetime.date) -> datetime.date:
+    # 0 - Sunday
+    target_day = 0
+    delta_day = target_day - d.isoweekday()
+
+    if delta_day >= 0:
+        delta_day -= 7
+
+    return d + datetime.timedelta(days=delta_day)
+
+
+def rank(
+    ids: array.array,
+    limit: int = 0,
+    weights: typing.Union[array.array, None] = None,
+) -> typing.List[typing.Tuple[int, int]]:
+    """
+    Ranks the ids in an integer-coded column by occurrences (or the sum of
+    their `weights`) as `(id, count)` pairs, most frequent first and ties in
+    id order. Negative ids are skipped. With a `limit`, the ranking stops
+    after the `limit`th entry and everything tied with it.
+    """
+
+    values = numpy.frombuffer(ids, dtype=numpy.int32)
+    mask = values >= 0
+    if weights is None:
+        counts = numpy.bincount(values[mask])
+    else:
+        counts = numpy.bincount(
+            values[mask],
+            weights=numpy.frombuffer(weights, dtype=numpy.int32)[mask],
+        ).astype(numpy.int64)
+
+    order = numpy.argsort(-counts, kind="stable")
+    order = order[counts[order] > 0]
+    counts = counts[order]
+
+    if limit and limit < len(counts):
+        # Counts are descending, so the ties with the cutoff directly follow it
+        end = numpy.searchsorted(-counts, -counts[limit - 1], side="right")
+        order, counts = order[:end], counts[:end]
+
+    return list(zip(order.tolist(), counts.tolist()))
+
+
+def local_day(epoch: int) -> int:
+    """Returns the epoch of the local midnight starting the day of an epoch"""
+
+    return int(
+        datetime.datetime.combine(
+            datetime.date.fromtimestamp(epoch), datetime.time()
+        ).timestamp()
+    )
+
+
+def join_strings(strings: typing.List[str]) -> str:
+    if len(strings) > 2:
+        return ", ".join(strings[:-1]) + ", and " + str(strings[-1])
+    elif len(strings) == 2:
+        return " and ".join(strings)
+    elif len(strings) == 1:
+        return strings[0]
+
+    return ""
+
+
+def basic_pluralize(word: str, count: int) -> str:
+    if count != 1:
+        return word + "s"
+
+    return word
+
+
+def backoff(backend: str, attempt: int, retry_after: typing.Union[str, None]) -> None:
+    global SESSIONS
+
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = 2**attempt
+
+    termcolor.cprint(
+        f"[{backend}] Rate limited, backing off for {delay:g}s "
+        f"(attempt {attempt + 1}/{MAX_RETRIES})",
+        "yellow",
+    )
+    METRICS.record_retry(backend, True)
+    SESSIONS.rate_limiter(backend).throttle(delay)
+
+
+def decode_json(body: bytes) -> typing.Any:
+    """Decodes a response body, with orjson if it's installed"""
+
+    return orjson.loads(body) if orjson is not None else json.loads(body)
+
+
+async def async_http_get(
+    backend: str, url: str, headers: dict = {}, params: dict = {}
+) -> typing.Union[CachedHTTPResponse, None]:
+    global SESSIONS, MAX_RETRIES
+
+    session = SESSIONS.get(backend)
+    for attempt in range(MAX_RETRIES):
+        try:
+            async with session.get(url, headers=headers, params=params) as response:
+                # MusicBrainz answers with a 503 when its rate limit is hit
+                if response.status in (429, 503):
+                    backoff(backend, attempt, response.headers.get("Retry-After"))
+                    continue
+
+                if response.ok and response.text != "":
+                    if not response.is_expired:
+                        body = await response.read()
+                        METRICS.record_response(
+                            backend, url, response.from_cache, len(body)
+                        )
+                        return CachedHTTPResponse(
+                            decode_json(body), response.from_cache
+                        )
+                    else:
+                        print(f"Expired response ({url})")
+                        METRICS.record_retry(backend, False)
+                        await session.delete_expired_responses()
+                        return await async_http_get(backend, url, headers, params)
+                else:
+                    METRICS.record_error(backend)
+                    return None
+        except Exception as e:
+            METRICS.record_error(backend)
+            print(f"URL: {url}")
+            print(f"Headers: {headers}")
+            print(f"Parameters: {params}")
+            print(f"Error: {e}")
+
+            return None
+
+    termcolor.cprint(f"[{backend}] Giving up on {url}", "red")
+    METRICS.record_error(backend)
+    return None
+
+
+async def lastfm_aget(
+    payload: dict, cache: bool = True
+) -> typing.Union[aiohttp.ClientResponse, None]:
+    global SESSIONS, BASE_URL, HEADERS, LAST_FM_API_KEY, MAX_RETRIES
+
+    payload["api_key"] = LAST_FM_API_KEY
+    payload["format"] = "json"
+
+    session = SESSIONS.get("lastfm")
+    for attempt in range(MAX_RETRIES):
+        try:
+            async with session.get(
+                BASE_URL,
+                headers=HEADERS,
+                params=payload,
+                # An expiry of 0 skips the cache entirely
+                expire_after=None if cache else 0,
+            ) as response:
+                if response.status == 429:
+                    backoff("lastfm", attempt, response.headers.get("Retry-After"))
+                    continue
+
+                if response.ok and response.text != "":
+                    if not response.is_expired:
+                        body = await response.read()
+                        METRICS.record_response(
+                            "lastfm", BASE_URL, response.from_cache, len(body)
+                        )
+                        response_json = decode_json(body)
+                    else:
+                        print(f"Expired response ({payload})")
+                        METRICS.record_retry("lastfm", False)
+                        await session.delete_expired_responses()
+                        return await lastfm_aget(payload, cache)
+                else:
+                    METRICS.record_error("lastfm")
+
+                    # Client errors come with Last.fm's error code (e.g. 6 for
+                    # tracks it doesn't know), which callers need to tell
+                    # apart from failed requests
+                    if 400 <= response.status < 500:
+                        try:
+                            return decode_json(await response.read())
+                        except ValueError:
+                            pass
+
+                    return None
+        except Exception as e:
+            METRICS.record_error("lastfm")
+            print(f"Parameters: {payload}")
+            print(f"Error: {e}")
+            return None
+
+        # Error 29 means the rate limit was exceeded, and can come back with a
+        # successful status code, so it must not stay cached
+        if response_json.get("error") == 29:
+            await session.delete_url(BASE_URL, params=payload)
+            backoff("lastfm", attempt, None)
+            continue
+
+        return response_json
+
+    termcolor.cprint(f"[lastfm] Giving up on {payload}", "red")
+    METRICS.record_error("lastfm")
+    return None
+
+
+async def authenticate_spotify() -> None:
+    global SPOTIFY_ACCESS_TOKEN, SPOTIFY_ACCESS_TOKEN_EXPIRES, SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET
+
+    # Client credentials flow, requested directly so the accounts endpoint can
+    # be replaced along with the others
+    async with SESSIONS.get("spotify").post(
+        SPOTIFY_ACCOUNTS_URL,
+        data={"grant_type": "client_credentials"},
+        auth=aiohttp.BasicAuth(SPOTIFY_CLIENT_ID or "", SPOTIFY_CLIENT_SECRET or ""),
+        # Tokens must never come from the cache
+        expire_after=0,
+    ) as response:
+        response.raise_for_status()
+        token = await response.json()
+
+    SPOTIFY_ACCESS_TOKEN = token["access_token"]
+    SPOTIFY_ACCESS_TOKEN_EXPIRES = (
+        time.time() + int(token["expires_in"]) - SPOTIFY_TOKEN_MARGIN
+    )
+
+
+def recent_tracks_payload(request: RecentTracksRequest) -> dict:
+    payload = {
+        "method": "user.getRecentTracks",
+        "user": request.username,
+        "page": request.page,
+        "limit": RECENT_TRACKS_LIMIT,
+        "to": request.end,
+    }
+    if request.start is not None:
+        payload["from"] = request.start
+
+    return payload
+
+
+async def get_recent_tracks_page(
+    request: RecentTracksRequest, output: bool = False
+) -> typing.Union[dict, None]:
+    if output:
+        print(f"[GRTP] Retrieving page {request.page}...")
+
+    recent_tracks = await lastfm_aget(recent_tracks_payload(request), cache=False)
+
+    if recent_tracks and "recenttracks" not in recent_tracks:
+        return None
+
+    return recent_tracks
+
+
+async def get_latest_scrobble(username: str) -> typing.Union[int, None]:
+    """
+    Returns the epoch of the user's newest scrobble from a single uncached
+    one-track page, or `None` if it isn't available
+    """
+
+    started = time.monotonic()
+    with METRICS.measure("probe"):
+        page = await lastfm_aget(
+            {"method": "user.getRecentTracks", "user": username, "limit": 1},
+            cache=False,
+        )
+
+    failed = not page or "recenttracks" not in page
+    METRICS.record_item("probe", time.monotonic() - started, failed)
+    if failed:
+        return None
+
+    # The track being played comes along with the newest scrobble
+    return max(
+        (
+            track.epoch_started
+            for track in parse_recent_tracks(page)
+            if not track.now_playing
+        ),
+        default=None,
+    )
+
+
+def parse_recent_tracks(page: dict) -> typing.List[RecentTrack]:
+    recent_tracks: typing.Union[typing.List[dict], dict] = page["recenttracks"]["track"]
+
+    # Pages with a single scrobble return it as an object instead of a list
+    if isinstance(recent_tracks, dict):
+        recent_tracks = [recent_tracks]
+
+    # Every scrobble of a sync goes through here, so each one is built in a
+    # single pass over the decoded page
+    parsed_tracks: typing.List[RecentTrack] = []
+    for track in recent_tracks:
+        artist, album = track["artist"], track["album"]
+        attributes = track.get("@attr")
+        now_playing = attributes is not None and "nowplaying" in attributes
+
+        parsed_tracks.append(
+            RecentTrack(
+                track["name"],
+                track["mbid"],
+                Artist(artist["#text"], artist["mbid"]),
+                Album(album["#text"], album["mbid"]),
+                now_playing and attributes["nowplaying"] == "true",
+                0 if now_playing else int(track["date"]["uts"]),
+            )
+        )
+
+    return parsed_tracks
+
+
+async def get_track_info(
+    track: BasicTrackInfo, output: bool = False
+) -> typing.Union[TrackInfo, None]:
+    if output:
+        print(f"[GTIS] {track.name} ({track.artist})")
+
+    track_info_request = await lastfm_aget(
+        {
+            "method": "track.getInfo",
+            "track": track.name,
+            "artist": track.artist,
+        }
+    )
+
+    if track_info_request:
+        # Tracks Last.fm doesn't know are passed on to the other sources as
+        # they were scrobbled, without a duration
+        if track_info_request.get("error") == 6:
+            return TrackInfo(
+                track.name,
+                track.mbid,
+                Artist(track.artist, ""),
+                Album(track.album, "") if track.album else None,
+                0,
+                0,
+            )
+        elif "error" in track_info_request:
+            return None
+
+        try:
+            track_info = track_info_request["track"]
+            return TrackInfo(
+                track_info["name"],
+                track.mbid,
+                Artist(
+                    track_info["artist"]["name"],
+                    track_info["artist"].get("mbid", ""),
+                ),
+                Album(track_info["album"]["title"], "")
+                if "album" in track_info
+                else None,
+                int(track_info["duration"]),
+                int(track_info["playcount"]),
+            )
+        except Exception as e:
+            print(e)
+            print(type(track_info_request))
+            print(track_info_request)
+
+            return None
+    else:
+        return None
+
+
+async def find_track(
+    search_track: BasicTrackInfo, output: bool = False
+) -> typing.Union[typing.Tuple[typing.Union[dict, None], BasicTrackInfo], None]:
+    """
+    Searches Spotify for the track, returning the match (or `None` if there
+    isn't one) with the searched track, or `None` if the search failed
+    """
+
+    global SPOTIFY_ACCESS_TOKEN, SPOTIFY_API_URL
+
+    request = await async_http_get(
+        "spotify",
+        f"{SPOTIFY_API_URL}/search",
+        headers={
+            "Authorization": f"Bearer {SPOTIFY_ACCESS_TOKEN}",
+            "Content-Type": "application/json",
+        },
+        params={
+            "q": " ".join(
+                f'{field}:"{value.replace(chr(34), "")}"'
+                for field, value in (
+                    ("track", search_track.name),
+                    ("artist", search_track.artist),
+                )
+            ),
+            "type": "track",
+            "limit": 5,
+        },
+    )
+    if request:
+        for track in request.response["tracks"]["items"]:
+            if output:
+                print(
+                    f"{track['name']} ({', '.join([artist['name'] for artist in remove_null(track['artists'])])})"
+                )
+
+            if track[
+                "name"
+            ].lower() == search_track.name.lower() and search_track.artist.lower() in [
+                artist["name"].lower() for artist in remove_null(track["artists"])
+            ]:
+                return (track, search_track)
+
+        return (None, search_track)
+    else:
+        return None
+
+
+async def get_spotify_tracks(
+    ids: typing.List[str], output: bool = False
+) -> typing.Union[typing.Dict[str, dict], None]:
+    """Retrieves up to 50 Spotify tracks by id in a single request"""
+
+    global SPOTIFY_ACCESS_TOKEN, SPOTIFY_API_URL
+
+    if output:
+        print(f"[SFTB] Refreshing {len(ids)} tracks")
+
+    request = await async_http_get(
+        "spotify",
+        f"{SPOTIFY_API_URL}/tracks",
+        headers={
+            "Authorization": f"Bearer {SPOTIFY_ACCESS_TOKEN}",
+            "Content-Type": "application/json",
+        },
+        params={"ids": ",".join(ids)},
+    )
+    if not request:
+        return None
+
+    # Unknown ids come back as nulls
+    return {track["id"]: track for track in remove_null(request.response["tracks"])}
+
+
+def lucene_phrase(value: str) -> str:
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+async def get_musicbrainz_recording_length(
+    mbid: str, output: bool = False
+) -> typing.Union[int, None]:
+    global HEADERS, MUSICBRAINZ_URL
+
+    if output:
+        print(f"[GMBD] Looking up recording {mbid}")
+
+    response = await async_http_get(
+        "musicbrainz",
+        f"{MUSICBRAINZ_URL}/recording/{mbid}",
+        headers=HEADERS,
+        params={"fmt": "json"},
+    )
+
+    # Last.fm's MBIDs aren't always recordings, which MusicBrainz answers
+    # with a 404
+    if not response or not response.response.get("length"):
+        return None
+
+    return int(response.response["length"])
+
+
+async def get_musicbrainz_durations(
+    search_tracks: typing.List[BasicTrackInfo], output: bool = False
+) -> typing.Union[typing.List[typing.Union[int, None]], None]:
+    """
+    Finds the durations of several tracks, looking recordings up directly by
+    MBID and searching for the rest with a single OR-ed query. Tracks that
+    weren't found have no duration, and if the search failed, the whole
+    batch is `None`.
+    """
+
+    global HEADERS, MUSICBRAINZ_URL
+
+    durations: typing.List[typing.Union[int, None]] = [None] * len(search_tracks)
+    for index, search_track in enumerate(search_tracks):
+        if search_track.mbid:
+            durations[index] = await get_musicbrainz_recording_length(
+                search_track.mbid, output
+            )
+
+    unresolved = [index for index, duration in enumerate(durations) if not duration]
+    if not unresolved:
+        return durations
+
+    if output:
+        print(f"[GMBD] Searching for {len(unresolved)} tracks")
+
+    response = await async_http_get(
+        "musicbrainz",
+        f"{MUSICBRAINZ_URL}/recording",
+        headers=HEADERS,
+        params={
+            "query": " OR ".join(
+                f"(recording:{lucene_phrase(search_tracks[index].name)}"
+                f" AND artist:{lucene_phrase(search_tracks[index].artist)})"
+                for index in unresolved
+            ),
+            "limit": 100,
+            "fmt": "json",
+        },
+    )
+    if not response:
+        return None
+
+    # Results are ordered by score, so the first match is the best one
+    lengths: typing.Dict[typing.Tuple[str, str], int] = {}
+    for result in response.response["recordings"]:
+        if not result.get("length"):
+            continue
+
+        for artist in result.get("artist-credit", []):
+            lengths.setdefault(
+                (normalize(result["title"]), normalize(artist["name"])),
+                int(result["length"]),
+            )
+
+    for index in unresolved:
+        durations[index] = lengths.get(
+            (
+                normalize(search_tracks[index].name),
+                normalize(search_tracks[index].artist),
+            )
+        )
+
+    return durations
+
+
+class BatchQueue:
+    """
+    Wraps a queue of `(key, item)` pairs, handing out whatever is waiting as
+    a single `(keys, items)` batch of up to `size` pairs
+    """
+
+    def __init__(self, queue: asyncio.Queue, size: int):
+        self.queue = queue
+        self.size = size
+        self.closed = False
+
+    def qsize(self) -> int:
+        return self.queue.qsize()
+
+    async def get(
+        self,
+    ) -> typing.Union[typing.Tuple[typing.Tuple, typing.List], None]:
+        if self.closed:
+            return None
+
+        # Batches are only formed when the stage asks for one, so the items
+        # that arrive while it waits for the rate limiter end up together
+        pairs = [await self.queue.get()]
+        while len(pairs) < self.size and not self.queue.empty():
+            pairs.append(self.queue.get_nowait())
+
+        if None in pairs:
+            self.closed = True
+            pairs = pairs[: pairs.index(None)]
+            if not pairs:
+                return None
+
+        keys, items = zip(*pairs)
+        return (keys, list(items))
+
+
+class PipelineStage:
+    """
+    Runs an executable over items, either from a list (returning the results
+    in input order) or streamed from a queue. The concurrency grows while
+    requests are quick and shrinks when the stage's backend throttles it or
+    the executable fails, by raising or by returning `None`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        executable: typing.Callable,
+        backend: typing.Union[str, None] = None,
+        target_latency: float = 2.0,
+        output: bool = False,
+    ):
+        self.name = name
+        self.executable = executable
+        self.backend = backend
+        self.target_latency = target_latency
+        self.output = output
+
+        (
+            self.min_concurrency,
+            self.concurrency,
+            self.max_concurrency,
+        ) = STAGE_CONCURRENCY.get(name, (1, 5, 5))
+        self.successes = 0
+
+    def adapt(self, latency: float, failed: bool, throttled: bool) -> None:
+        if throttled:
+            self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+            self.successes = 0
+        elif failed:
+            self.concurrency = max(self.min_concurrency, self.concurrency - 1)
+            self.successes = 0
+        elif latency <= self.target_latency:
+            # Grow by one after a full round of quick, successful items
+            self.successes += 1
+            if self.successes >= self.concurrency:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                self.successes = 0
+
+    async def execute(
+        self, key: typing.Any, item: typing.Any
+    ) -> typing.Tuple[typing.Any, typing.Any]:
+        global SESSIONS
+
+        rate_limiter = SESSIONS.rate_limiter(self.backend) if self.backend else None
+        throttle_events = rate_limiter.throttle_events if rate_limiter else 0
+        started = time.monotonic()
+
+        # Executables catch their own request errors and return `None`
+        try:
+            result = await self.executable(item, self.output)
+            failed = result is None
+        except Exception as error:
+            print(f"[WORKER::{self.name}] Error: {error}")
+            result = None
+            failed = True
+
+        latency = time.monotonic() - started
+        METRICS.record_item(self.name, latency, failed)
+        self.adapt(
+            latency,
+            failed,
+            rate_limiter is not None and rate_limiter.throttle_events > throttle_events,
+        )
+
+        return (key, result)
+
+    async def stream(
+        self,
+        inputs: asyncio.Queue,
+        on_result: typing.Callable[[typing.Any, typing.Any], None],
+    ) -> None:
+        """
+        Runs the executable over `(key, item)` pairs taken from `inputs` until
+        `None` is received, passing each key and result to `on_result` as soon
+        as the item is done
+        """
+
+        with METRICS.measure(self.name):
+            await self.stream_items(inputs, on_result)
+
+    async def stream_items(
+        self,
+        inputs: asyncio.Queue,
+        on_result: typing.Callable[[typing.Any, typing.Any], None],
+    ) -> None:
+        pending: typing.Set[asyncio.Task] = set()
+        next_input: typing.Union[asyncio.Task, None] = None
+        closed = False
+
+        while not closed or pending:
+            # Only take more items while below the current concurrency
+            if not closed and not next_input and len(pending) < self.concurrency:
+                next_input = asyncio.create_task(inputs.get())
+
+            done, _ = await asyncio.wait(
+                pending | {next_input} if next_input else pending,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+
+            if next_input in done:
+                done.remove(next_input)
+                next_item = next_input.result()
+                next_input = None
+
+                if next_item is None:
+                    closed = True
+                else:
+                    pending.add(asyncio.create_task(self.execute(*next_item)))
+
+            for task in done:
+                pending.remove(task)
+                on_result(*task.result())
+
+            if self.output and done:
+                print(
+                    f"[WORKER::{self.name}] {inputs.qsize() + len(pending)} items "
+                    f"left ({self.concurrency} workers)"
+                )
+
+    async def run(
+        self,
+        items: typing.List[typing.Any],
+        on_result: typing.Union[
+            typing.Callable[[typing.Any, typing.Any], None], None
+        ] = None,
+    ) -> typing.List[typing.Any]:
+        results: typing.List[typing.Any] = [None] * len(items)
+
+        inputs: asyncio.Queue = asyncio.Queue()
+        for index, item in enumerate(items):
+            inputs.put_nowait((index, item))
+        inputs.put_nowait(None)
+
+        def store_result(index: int, result: typing.Any) -> None:
+            results[index] = result
+            if on_result:
+                on_result(items[index], result)
+
+        await self.stream(inputs, store_result)
+        return results
+
+
+class TrackEnricher:
+    """
+    Streams unique tracks through `track.getInfo` as they're found, passing
+    tracks without a duration straight on to Spotify, then MusicBrainz
+    """
+
+    def __init__(
+        self,
+        bounds: typing.Tuple[int, typing.Union[int, None]] = (0, None),
+        output: bool = False,
+        metadata: typing.Union[MetadataStore, None] = None,
+    ):
+        global SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET
+
+        self.bounds = bounds
+        self.output = output
+        self.spotify = bool(SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET)
+
+        # A shared metadata store stays open for the next enricher
+        self.owns_metadata = metadata is None
+        self.metadata = metadata or MetadataStore()
+        self.catalog = TrackCatalog()
+        self.unique_tracks: typing.Dict[typing.Tuple[str, str], BasicTrackInfo] = {}
+        self.cached_count = 0
+        self.no_duration_count = 0
+        self.spotify_count = 0
+        self.spotify_refresh_count = 0
+        self.musicbrainz_count = 0
+
+        self.track_info_queue: asyncio.Queue = asyncio.Queue()
+        self.spotify_queue: asyncio.Queue = asyncio.Queue()
+        self.musicbrainz_queue: asyncio.Queue = asyncio.Queue()
+        self.spotify_refresh_queue: asyncio.Queue = asyncio.Queue()
+        self.spotify_refreshes: typing.List[
+            typing.Tuple[typing.Tuple[str, str], str]
+        ] = []
+        self.spotify_refresh_task: typing.Union[asyncio.Task, None] = None
+        self.spotify_lock = asyncio.Lock()
+        self.tasks: typing.List[asyncio.Task] = []
+        self.claimed: typing.Set[typing.Tuple[str, str]] = set()
+        self.joined: typing.List[asyncio.Task] = []
+        # Tracks a source failed to answer for, which can't be recorded as
+        # misses, and the ones left without a duration because of it
+        self.failed: typing.Set[typing.Tuple[str, str]] = set()
+        self.unresolved: typing.Set[typing.Tuple[str, str]] = set()
+        self.failed_count = 0
+
+    def start(self) -> None:
+        termcolor.cprint("Retrieving unique track information...", attrs=["bold"])
+
+        self.spotify_refresh_task = asyncio.create_task(self.run_spotify_refresh())
+        self.tasks = [
+            self.spotify_refresh_task,
+            asyncio.create_task(self.run_track_info()),
+            asyncio.create_task(self.run_spotify()),
+            asyncio.create_task(self.run_musicbrainz()),
         ]
 
-        if SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET:
-            print(
-                f"MusicBrainz durations found: {len(post_spotify_uti) - len(remove_null(WORK_QUEUE_OUTPUT))}"
+    def add(self, tracks: typing.List[RecentTrack]) -> None:
+        start, end = self.bounds
+
+        for track in tracks:
+            if track.now_playing or track.epoch_started < start:
+                continue
+            if end is not None and track.epoch_started >= end:
+                continue
+
+            key = TrackCatalog.key(track.name, track.artist.name)
+            if key in self.unique_tracks:
+                continue
+
+            unique_track = BasicTrackInfo(
+                track.name,
+                track.artist.name,
+                track.album.name if track.album else None,
+                track.mbid,
+            )
+            self.unique_tracks[key] = unique_track
+
+            # Only go to the network for tracks that were never resolved (or
+            # whose resolution expired)
+            metadata = self.metadata.get(unique_track)
+            if metadata:
+                track_info, _ = metadata
+                self.catalog.set(key, track_info)
+                self.cached_count += 1
+                continue
+
+            # Wait for another enricher already resolving the track instead
+            # of looking it up again
+            flight = TRACK_FLIGHTS.claim(key)
+            if flight is not None:
+                self.joined.append(asyncio.create_task(self.join(key, flight)))
+                continue
+
+            self.claimed.add(key)
+
+            # Tracks Spotify resolved before are refreshed by id, in bulk
+            spotify_metadata = (
+                self.metadata.get_spotify(unique_track) if self.spotify else None
+            )
+            if spotify_metadata:
+                track_info, spotify_id = spotify_metadata
+                self.catalog.set(key, track_info)
+                self.spotify_refreshes.append((key, spotify_id))
+                if len(self.spotify_refreshes) == SPOTIFY_BATCH_SIZE:
+                    self.queue_spotify_refreshes()
+            else:
+                self.track_info_queue.put_nowait((key, unique_track))
+
+    def queue_spotify_refreshes(self) -> None:
+        self.spotify_refresh_queue.put_nowait(
+            (
+                tuple(self.spotify_refreshes),
+                [spotify_id for _, spotify_id in self.spotify_refreshes],
             )
+        )
+        self.spotify_refreshes = []
+
+    async def join(self, key: typing.Tuple[str, str], flight: asyncio.Future) -> None:
+        track_info = await flight
+        if track_info:
+            self.catalog.set(key, track_info)
+        else:
+            self.unresolved.add(key)
+
+    async def finish(self) -> TrackCatalog:
+        # Refreshes that fail go through `track.getInfo`, so they have to be
+        # done before it's closed
+        if self.spotify_refreshes:
+            self.queue_spotify_refreshes()
+        await self.spotify_refresh_queue.put(None)
+        await self.spotify_refresh_task
+
+        await self.track_info_queue.put(None)
+        await asyncio.gather(*self.tasks)
+        await asyncio.gather(*self.joined)
+        self.close_metadata()
+
+        print()
+        print(f"Tracks from the metadata store: {self.cached_count}")
+        if self.spotify_refresh_count:
+            print(f"Spotify durations refreshed: {self.spotify_refresh_count}")
+        print(f"Tracks with no duration: {self.no_duration_count}")
+        if self.failed_count:
+            print(f"Tracks Last.fm failed to answer for: {self.failed_count}")
+        if self.no_duration_count != 0 or self.failed_count:
+            if self.spotify:
+                print(f"Spotify durations found: {self.spotify_count}")
+
+            print(f"MusicBrainz durations found: {self.musicbrainz_count}")
             print(
-                f"Total durations found: {len(pre_spotify_uti) - len(post_duration_uti)}"
+                "Tracks without durations: "
+                + str(
+                    self.no_duration_count
+                    + self.failed_count
+                    - self.spotify_count
+                    - self.musicbrainz_count
+                )
             )
+
+        return self.catalog
+
+    def cancel(self) -> None:
+        for task in self.tasks + self.joined:
+            task.cancel()
+
+        # Enrichers waiting on the tracks claimed here get no duration
+        for key in self.claimed:
+            TRACK_FLIGHTS.release(key)
+
+        self.close_metadata()
+
+    def close_metadata(self) -> None:
+        if self.owns_metadata:
+            self.metadata.close()
+        else:
+            self.metadata.flush()
+
+    def search_track(self, key: typing.Tuple[str, str]) -> BasicTrackInfo:
+        # Prefer Last.fm's corrected names, falling back to the scrobbled album
+        unique_track = self.unique_tracks[key]
+        track_info = self.catalog.get(key)
+
+        return BasicTrackInfo(
+            track_info.name,
+            track_info.artist.name,
+            track_info.album.name if track_info.album else unique_track.album,
+            unique_track.mbid,
+        )
+
+    def resolve(
+        self,
+        key: typing.Tuple[str, str],
+        source: str,
+        duration: int = 0,
+        spotify_id: typing.Union[str, None] = None,
+    ) -> None:
+        if duration:
+            self.catalog.set_duration(key, duration)
+
+        self.metadata.put(
+            self.unique_tracks[key], self.catalog.get(key), source, spotify_id
+        )
+        self.release(key, self.catalog.get(key))
+
+    def release(
+        self, key: typing.Tuple[str, str], track_info: typing.Union[TrackInfo, None]
+    ) -> None:
+        self.claimed.discard(key)
+        TRACK_FLIGHTS.release(key, track_info)
+
+    def on_track_info(
+        self, key: typing.Tuple[str, str], track_info: typing.Union[TrackInfo, None]
+    ) -> None:
+        # Failed requests are left for the next run instead of being recorded
+        if not track_info:
+            self.failed_count += 1
+            self.unresolved.add(key)
+            self.release(key, None)
+            return
+
+        self.catalog.set(key, track_info)
+        if track_info.duration != 0:
+            self.resolve(key, "lastfm")
+        else:
+            self.no_duration_count += 1
+            (self.spotify_queue if self.spotify else self.musicbrainz_queue).put_nowait(
+                (key, self.search_track(key))
+            )
+
+    def on_spotify_track(
+        self,
+        key: typing.Tuple[str, str],
+        result: typing.Union[typing.Tuple[dict, BasicTrackInfo], None],
+    ) -> None:
+        track = result[0] if result else None
+        if track:
+            self.resolve(key, "spotify", int(track["duration_ms"]), track["id"])
+            self.spotify_count += 1
         else:
-            print(f"MusicBrainz durations found: {len(remove_null(WORK_QUEUE_OUTPUT))}")
+            if result is None:
+                self.failed.add(key)
+
+            self.musicbrainz_queue.put_nowait((key, self.search_track(key)))
+
+    def on_musicbrainz_durations(
+        self,
+        keys: typing.Tuple[typing.Tuple[str, str], ...],
+        durations: typing.Union[typing.List[typing.Union[int, None]], None],
+    ) -> None:
+        if durations is None:
+            for key in keys:
+                self.failed.add(key)
+                self.on_musicbrainz_duration(key, None)
+
+            return
+
+        for key, duration in zip(keys, durations):
+            self.on_musicbrainz_duration(
+                key, (duration, self.unique_tracks[key]) if duration else None
+            )
+
+    def on_musicbrainz_duration(
+        self,
+        key: typing.Tuple[str, str],
+        result: typing.Union[typing.Tuple[int, BasicTrackInfo], None],
+    ) -> None:
+        if result:
+            duration, _ = result
+            self.resolve(key, "musicbrainz", duration)
+            self.musicbrainz_count += 1
+        elif key in self.failed:
+            # Enrichers waiting on the track see it as unresolved too
+            self.unresolved.add(key)
+            self.release(key, None)
+        else:
+            self.resolve(key, "miss")
+
+    def on_spotify_tracks(
+        self,
+        refreshes: typing.Tuple[typing.Tuple[typing.Tuple[str, str], str], ...],
+        tracks: typing.Union[typing.Dict[str, dict], None],
+    ) -> None:
+        for key, spotify_id in refreshes:
+            track = (tracks or {}).get(spotify_id)
+            if track and track["duration_ms"]:
+                self.resolve(key, "spotify", int(track["duration_ms"]), spotify_id)
+                self.spotify_refresh_count += 1
+            else:
+                # Resolve the track from scratch when its id stopped working
+                self.track_info_queue.put_nowait((key, self.unique_tracks[key]))
+
+    async def authenticate_spotify(self) -> None:
+        global SPOTIFY_ACCESS_TOKEN, SPOTIFY_ACCESS_TOKEN_EXPIRES
+
+        # Long-running servers outlive the token, so renew it when it expires
+        async with self.spotify_lock:
+            if not SPOTIFY_ACCESS_TOKEN or time.time() >= SPOTIFY_ACCESS_TOKEN_EXPIRES:
+                await authenticate_spotify()
+
+    async def find_spotify_track(
+        self, search_track: BasicTrackInfo, output: bool = False
+    ) -> typing.Union[typing.Tuple[dict, BasicTrackInfo], None]:
+        await self.authenticate_spotify()
+        return await find_track(search_track, output)
+
+    async def get_spotify_tracks(
+        self, ids: typing.List[str], output: bool = False
+    ) -> typing.Union[typing.Dict[str, dict], None]:
+        await self.authenticate_spotify()
+        return await get_spotify_tracks(ids, output)
+
+    async def run_spotify_refresh(self) -> None:
+        await PipelineStage(
+            "SFTB", self.get_spotify_tracks, "spotify", output=self.output
+        ).stream(self.spotify_refresh_queue, self.on_spotify_tracks)
+
+    async def run_track_info(self) -> None:
+        await PipelineStage("GTI", get_track_info, "lastfm", output=self.output).stream(
+            self.track_info_queue, self.on_track_info
+        )
+
+        await (self.spotify_queue if self.spotify else self.musicbrainz_queue).put(None)
+
+    async def run_spotify(self) -> None:
+        if not self.spotify:
+            return
+
+        await PipelineStage(
+            "SFTD", self.find_spotify_track, "spotify", output=self.output
+        ).stream(self.spotify_queue, self.on_spotify_track)
+
+        await self.musicbrainz_queue.put(None)
+
+    async def run_musicbrainz(self) -> None:
+        await PipelineStage(
+            "MBD", get_musicbrainz_durations, "musicbrainz", output=self.output
+        ).stream(
+            BatchQueue(self.musicbrainz_queue, MUSICBRAINZ_BATCH_SIZE),
+            self.on_musicbrainz_durations,
+        )
+
 
-        print(f"Tracks without durations: {len(post_duration_uti)}")
+async def get_unique_tracks(
+    tracks: typing.List[RecentTrack],
+) -> typing.Union[typing.Tuple[typing.List[BasicTrackInfo], TrackCatalog], None,]:
+    global OUTPUT
 
-    if unique_tracks and unique_track_info:
-        return (unique_track, unique_track_info)
+    enricher = TrackEnricher(output=OUTPUT)
+    enricher.start()
+    enricher.add(tracks)
+    catalog: TrackCatalog = await enricher.finish()
+
+    if enricher.unique_tracks and catalog:
+        return (list(enricher.unique_tracks.values()), catalog)
     else:
         return None
 
 
-async def get_recent_tracks() -> typing.Union[
-    typing.Tuple[typing.List[RecentTrack], typing.List[TrackInfo]],
-    None,
-]:
-    global WORK_QUEUE_OUTPUT, WORK_QUEUE, OUTPUT, HISTORY_OUTPUT, USERNAME
+async def get_recent_tracks_range(
+    username: str,
+    start: typing.Union[int, None],
+    end: int,
+    on_tracks: typing.Union[
+        typing.Callable[[typing.List[RecentTrack]], None], None
+    ] = None,
+) -> typing.Union[typing.List[RecentTrack], None]:
+    """
+    Retrieves every scrobble in `[start, end]`, passing each page's scrobbles
+    to `on_tracks` as soon as the page arrives
+    """
+
+    global OUTPUT
+
+    first_request = RecentTracksRequest(username, 1, start, end)
+    started = time.monotonic()
+    with METRICS.measure("GRT"):
+        first_recent_page: typing.Union[dict, None] = await get_recent_tracks_page(
+            first_request
+        )
 
-    # Get recent tracks
-    termcolor.cprint("Retrieving recent tracks...", attrs=["bold"])
+    # Counted like the pages the pipeline stage retrieves
+    METRICS.record_item("GRT", time.monotonic() - started, first_recent_page is None)
+    if not first_recent_page:
+        return None
 
-    first_recent_page: typing.Union[aiohttp.ClientResponse, None] = await lastfm_aget(
-        {"method": "user.getRecentTracks", "user": USERNAME, "page": 1}
-    )
-    if first_recent_page:
-        first_recent_page_json: dict = first_recent_page
+    tracks: typing.List[RecentTrack] = []
+    failed = False
 
-        for page in range(
-            2,
-            int(first_recent_page_json["recenttracks"]["@attr"]["totalPages"]) + 1,
-        ):
-            await WORK_QUEUE.put(page)
+    def on_page(_: RecentTracksRequest, page: typing.Union[dict, None]) -> None:
+        nonlocal failed
 
-        WORK_QUEUE_OUTPUT.append(first_recent_page_json)
-    else:
-        print(first_recent_page.status_code)
-        print(first_recent_page.text)
+        if not page:
+            failed = True
+            return
 
-        exit(termcolor.colored("Unable to retrieve recent tracks", "red"))
+        page_tracks = parse_recent_tracks(page)
+        tracks.extend(page_tracks)
+        if on_tracks:
+            on_tracks(page_tracks)
 
-    await start_workers(
-        "GRT", get_recent_tracks_page, clear_work_queue_output=False, output=OUTPUT
+    on_page(first_request, first_recent_page)
+    await PipelineStage("GRT", get_recent_tracks_page, "lastfm", output=OUTPUT).run(
+        [
+            first_request._replace(page=page)
+            for page in range(
+                2,
+                int(first_recent_page["recenttracks"]["@attr"]["totalPages"]) + 1,
+            )
+        ],
+        on_page,
     )
-    if ERROR:
-        exit(ERROR)
 
-    paged_tracks: typing.List[dict] = [
-        page["recenttracks"]["track"] for page in remove_null(WORK_QUEUE_OUTPUT)
-    ]
+    if failed:
+        return None
 
-    all_recent: typing.List[dict] = [
-        item for sublist in paged_tracks for item in sublist
-    ]
+    return tracks
 
-    for track in all_recent:
-        try:
-            track["name"]
-        except TypeError:
-            print(track)
-            print(all_recent.index(track))
-
-    tracks: typing.List[RecentTrack] = [
-        RecentTrack(
-            track["name"],
-            track["mbid"],
-            Artist(track["artist"]["#text"], track["artist"]["mbid"]),
-            Album(track["album"]["#text"], track["album"]["mbid"]),
-            json.loads(track["@attr"]["nowplaying"])
-            if "@attr" in track and "nowplaying" in track["@attr"]
-            else False,
-            0
-            if "@attr" in track and "nowplaying" in track["@attr"]
-            else int(track["date"]["uts"]),
-        )
-        for track in all_recent
-    ]
 
-    if HISTORY_OUTPUT:
-        with open(f"tracks_{USERNAME}.csv", "w") as tracks_file:
-            tracks_file.write(
-                "\n".join(
-                    [
-                        "trackName,artistName,albumName,nowPlaying,epochStarted",
-                        *[
-                            f'"{strip_quotes(track.name)}","{strip_quotes(track.artist.name)}","{strip_quotes(track.album.name)}",{json.dumps(track.now_playing)},{track.epoch_started}'
-                            for track in tracks
-                        ],
-                    ]
-                )
-            )
+async def get_recent_tracks(
+    bounds: typing.Tuple[typing.Union[int, None], int],
+    username: str,
+    store: typing.Union[ScrobbleStore, None] = None,
+    metadata: typing.Union[MetadataStore, None] = None,
+) -> typing.Union[typing.Tuple[ScrobbleColumns, bool], None]:
+    """
+    Syncs the user's scrobbles in the bounds and returns them with their
+    durations, along with whether every track's duration was looked up
+    (rather than left for the next run after a failed request). Stores that
+    are passed in are left open for later syncs.
+    """
 
-    # Find unique tracks
-    unique_tracks_raw = await get_unique_tracks(tracks)
-    if unique_tracks_raw:
-        unique_tracks, unique_track_info = unique_tracks_raw
+    global OUTPUT, HISTORY_OUTPUT, FULL_RESYNC
 
-    if tracks and unique_tracks:
-        return (tracks, unique_track_info)
+    owns_store = store is None
+    store = store or ScrobbleStore(username)
+    coverage: typing.Union[typing.Tuple[int, int], None] = (
+        None if FULL_RESYNC else store.coverage()
+    )
+
+    # Pinning the end of the range keeps the pages stable while new scrobbles
+    # come in during the sync
+    start, end = bounds
+    sync_from = start or 0
+    sync_to = min(end, int(time.time())) - 1
+
+    # Only ask for the parts of the timeframe the store doesn't cover yet,
+    # keeping the covered range contiguous
+    ranges: typing.List[typing.Tuple[typing.Union[int, None], int]] = []
+    if coverage is None:
+        termcolor.cprint("Retrieving recent tracks (full sync)...", attrs=["bold"])
+        ranges.append((start, sync_to))
     else:
-        return None
+        termcolor.cprint("Retrieving new recent tracks...", attrs=["bold"])
+
+        covered_from, covered_to = coverage
+        if sync_from < covered_from:
+            ranges.append((start, covered_from - 1))
+        if sync_to > covered_to:
+            ranges.append((covered_to + 1, sync_to))
+
+        sync_from = min(sync_from, covered_from)
+        sync_to = max(sync_to, covered_to)
+
+    # Timeframes start and end at local midnights, so they're answered from
+    # the daily play counts
+    daily = (not start or local_day(start) == start) and local_day(end) == end
+
+    # Enrich the unique tracks while the pages are still being retrieved,
+    # starting with the ones already stored
+    enricher = TrackEnricher((start or 0, end), output=OUTPUT, metadata=metadata)
+    enricher.start()
+    if coverage is not None:
+        enricher.add(
+            store.load_unique_tracks(start or 0, end)
+            if daily
+            else store.load(start or 0, end)
+        )
 
+    exporter = (
+        HistoryExporter(username, parquet=HISTORY_OUTPUT == "parquet")
+        if HISTORY_OUTPUT
+        else None
+    )
 
-async def analyze_tracks(
-    recent_tracks: typing.List[RecentTrackWithDuration],
-) -> typing.Tuple[
-    typing.List[VeryBasicTrackInfo], typing.List[Artist], typing.List[Album], int
-]:
-    tracks: typing.List[VeryBasicTrackInfo] = [
-        VeryBasicTrackInfo(track.name, track.artist.name if track.artist else "N/A")
-        for track in recent_tracks
-    ]
-    artists: typing.List[Artist] = [track.artist for track in recent_tracks]
-    albums: typing.List[Album] = [track.album for track in recent_tracks if track.album]
+    def on_tracks(tracks: typing.List[RecentTrack]) -> None:
+        enricher.add(tracks)
+        if exporter:
+            exporter.add(tracks)
+
+    # Only store the new scrobbles once every page was retrieved, otherwise
+    # the next sync would skip the missing pages
+    new_tracks: typing.List[RecentTrack] = []
+    for range_start, range_end in ranges:
+        range_tracks = await get_recent_tracks_range(
+            username, range_start, range_end, on_tracks
+        )
+        if range_tracks is None:
+            termcolor.cprint("Unable to retrieve recent tracks", "red")
+            enricher.cancel()
+            if exporter:
+                exporter.discard()
+            if owns_store:
+                store.close()
+
+            return None
 
-    top_tracks_raw: typing.List[str] = value_counter([track.name for track in tracks])
-    top_tracks: typing.List[VeryBasicTrackInfo] = []
+        new_tracks.extend(range_tracks)
 
-    for top_track in top_tracks_raw:
-        for track in tracks:
-            if track.name == top_track:
-                top_tracks.append(track)
-                break
+    new_track_count = store.replace(
+        new_tracks, (sync_from, sync_to), full=coverage is None
+    )
+    print(f"New scrobbles: {new_track_count}")
+
+    # Scrobbles older than the export can't be appended to it in order
+    if exporter:
+        exporter.commit(
+            store,
+            append=coverage is not None
+            and all(
+                range_start is not None and range_start > coverage[1]
+                for range_start, _ in ranges
+            ),
+            previous_coverage=coverage,
+        )
 
-    top_artists_raw: typing.List[str] = value_counter(
-        [artist.name for artist in artists]
+    columns = (
+        store.load_daily_plays(start or 0, end)
+        if daily
+        else store.load_columns(start or 0, end)
     )
-    top_artists: typing.List[Artist] = []
 
-    for top_artist in top_artists_raw:
-        for artist in artists:
-            if artist.name == top_artist:
-                top_artists.append(artist)
-                break
+    if owns_store:
+        store.close()
+
+    columns.set_durations(await enricher.finish())
+
+    return (columns, not enricher.unresolved)
+
 
-    top_albums_raw: typing.List[str] = value_counter([album.name for album in albums])
-    top_albums: typing.List[Album] = []
+def rank_columns(columns: ScrobbleColumns, limit: int = 0) -> dict:
+    """Ranks the tracks, artists, and albums of a history by plays"""
+
+    return {
+        "tracks": [
+            dict(zip(("name", "artist"), columns.tracks[track_id]), plays=plays)
+            for track_id, plays in rank(columns.track_ids, limit, columns.plays)
+        ],
+        "artists": [
+            {"name": columns.artists[artist_id], "plays": plays}
+            for artist_id, plays in rank(columns.artist_ids, limit, columns.plays)
+        ],
+        "albums": [
+            {"name": columns.albums[album_id], "plays": plays}
+            for album_id, plays in rank(columns.album_ids, limit, columns.plays)
+        ],
+    }
 
-    for top_album in top_albums_raw:
-        for album in albums:
-            if album.name == top_album:
-                top_albums.append(album)
-                break
 
-    total_duration = sum([track.duration for track in recent_tracks])
+def sketch_columns(
+    columns: ScrobbleColumns, capacity: int
+) -> typing.Dict[str, HeavyHitters]:
+    """
+    Sketches the tracks, artists, and albums of a history by plays, keyed by
+    name (instead of id), so sketches of other histories can be merged in
+    """
 
-    if not top_tracks:
-        top_tracks = []
+    sketches: typing.Dict[str, HeavyHitters] = {}
+    for kind, ids, values in (
+        ("tracks", columns.track_ids, columns.tracks),
+        ("artists", columns.artist_ids, columns.artists),
+        ("albums", columns.album_ids, columns.albums),
+    ):
+        # Rows are streamed straight into the sketches, so nothing is counted
+        # per distinct value. Rows of daily play counts add a whole day at once.
+        sketches[kind] = HeavyHitters(capacity)
+        sketches[kind].add_column(values, ids, columns.plays)
+
+    return sketches
+
+
+def approximate_ranking(
+    sketches: typing.Dict[str, HeavyHitters], limit: int = 0
+) -> dict:
+    """
+    Ranks sketched tracks, artists, and albums like `rank_columns`, with the
+    most each play count may be overestimated by, and the most any value left
+    out of the ranking may have been played
+    """
+
+    return {
+        "tracks": [
+            dict(zip(("name", "artist"), track), plays=plays, error=error)
+            for track, plays, error in sketches["tracks"].top(limit)
+        ],
+        "artists": [
+            {"name": artist, "plays": plays, "error": error}
+            for artist, plays, error in sketches["artists"].top(limit)
+        ],
+        "albums": [
+            {"name": album, "plays": plays, "error": error}
+            for album, plays, error in sketches["albums"].top(limit)
+        ],
+        "max_error": {kind: sketch.max_error() for kind, sketch in sketches.items()},
+    }
 
-    if not top_artists:
-        top_artists = []
 
-    if not top_albums:
-        top_albums = []
+async def analyze_tracks(
+    columns: ScrobbleColumns,
+) -> typing.Tuple[
+    typing.List[VeryBasicTrackInfo], typing.List[Artist], typing.List[Album], int
+]:
+    # Ranking with a limit of one leaves everything tied for the most plays
+    top_tracks: typing.List[VeryBasicTrackInfo] = [
+        VeryBasicTrackInfo(*columns.tracks[track_id])
+        for track_id, _ in rank(columns.track_ids, 1, columns.plays)
+    ]
+    top_artists: typing.List[Artist] = [
+        Artist(columns.artists[artist_id], "")
+        for artist_id, _ in rank(columns.artist_ids, 1, columns.plays)
+    ]
+    top_albums: typing.List[Album] = [
+        Album(columns.albums[album_id], "")
+        for album_id, _ in rank(columns.album_ids, 1, columns.plays)
+    ]
+    total_duration = int(
+        numpy.dot(
+            numpy.frombuffer(columns.durations, dtype=numpy.int32).astype(numpy.int64),
+            numpy.frombuffer(columns.plays, dtype=numpy.int32),
+        )
+    )
 
     return (top_tracks, top_artists, top_albums, total_duration)
 
@@ -850,161 +3057,403 @@ async def generate_analysis_messages(
     return messages
 
 
-async def main(
-    timeframe: Timeframe = Timeframe.LAST_WEEK,
-) -> typing.Union[typing.List[RecentTrackWithDuration], dict]:
-    tracks = await get_recent_tracks()
-    if not tracks:
-        exit(termcolor.colored("Recent tracks not available", "red"))
+async def analyze_timeframe(
+    columns: ScrobbleColumns,
+    timeframe: Timeframe,
+    sketches: typing.Union[typing.Dict[str, HeavyHitters], None] = None,
+) -> dict:
+    with METRICS.measure("analysis"):
+        analyzed_tracks = await analyze_tracks(columns)
+        play_count = columns.play_count()
+
+        generated_messages = await generate_analysis_messages(analyzed_tracks)
+        generated_messages["tracks"] = (
+            f"You listened to {'{:,}'.format(play_count)} {basic_pluralize('track', play_count)}"
+            if not RAW_DUMP
+            else play_count
+        )
+        generated_messages["timeframe"] = timeframe.value.lower()
+        if APPROXIMATE_CAPACITY and (RANKING_SIZE or sketches is not None):
+            timeframe_sketches = sketch_columns(columns, APPROXIMATE_CAPACITY)
+            if RANKING_SIZE:
+                generated_messages["ranking"] = approximate_ranking(
+                    timeframe_sketches, RANKING_SIZE
+                )
 
-    recent_tracks, unique_track_info = tracks
+            # Merge into the sketches of every analyzed history
+            if sketches is not None:
+                for kind, sketch in timeframe_sketches.items():
+                    if kind in sketches:
+                        sketches[kind].merge(sketch)
+                    else:
+                        sketches[kind] = sketch
+        elif RANKING_SIZE:
+            generated_messages["ranking"] = rank_columns(columns, RANKING_SIZE)
 
-    timeframe_tracks: typing.List[RecentTrack] = []
-    if timeframe == Timeframe.TODAY:
-        today = datetime.date.today()
-        tomorrow = today + datetime.timedelta(days=1)
-        today_timestamp = int(
-            datetime.datetime(today.year, today.month, today.day, 0, 0, 0).timestamp()
-        )
-        tomorrow_timestamp = int(
-            datetime.datetime(
-                tomorrow.year, tomorrow.month, tomorrow.day, 0, 0, 0
-            ).timestamp()
-        )
+    return generated_messages
 
-        timeframe_tracks = [
-            track
-            for track in recent_tracks
-            if tomorrow_timestamp > track.epoch_started > today_timestamp
-        ]
-    elif timeframe == Timeframe.THIS_WEEK:
-        sunday = last_sunday(datetime.date.today())
-
-        timeframe_tracks = [
-            track
-            for track in recent_tracks
-            if 0
-            <= (datetime.date.fromtimestamp(track.epoch_started) - sunday).days
-            <= 7
-        ]
-    elif timeframe == Timeframe.THIS_MONTH:
-        this_month = datetime.date.today()
-        next_month = this_month + dateutil.relativedelta.relativedelta(months=1)
-        this_month_timestamp = int(
-            datetime.datetime(this_month.year, this_month.month, 1, 0, 0, 0).timestamp()
-        )
-        next_month_timestamp = int(
-            datetime.datetime(next_month.year, next_month.month, 1, 0, 0, 0).timestamp()
-        )
 
-        timeframe_tracks = [
-            track
-            for track in recent_tracks
-            if next_month_timestamp > track.epoch_started > this_month_timestamp
-        ]
-    elif timeframe == Timeframe.THIS_YEAR:
-        this_year = datetime.date.today()
-        next_year = this_year + dateutil.relativedelta.relativedelta(years=1)
-        this_year_timestamp = int(
-            datetime.datetime(this_year.year, 1, 1, 0, 0, 0).timestamp()
-        )
-        next_year_timestamp = int(
-            datetime.datetime(next_year.year, 1, 1, 0, 0, 0).timestamp()
-        )
+def analysis_options() -> str:
+    """The settings that change an analysis, which stored analyses must match"""
 
-        timeframe_tracks = [
-            track
-            for track in recent_tracks
-            if next_year_timestamp > track.epoch_started > this_year_timestamp
-        ]
+    return json.dumps(
+        {
+            "raw_dump": bool(RAW_DUMP),
+            "ranking_size": RANKING_SIZE,
+            "approximate_capacity": APPROXIMATE_CAPACITY,
+        },
+        sort_keys=True,
+    )
 
-    elif timeframe == Timeframe.YESTERDAY:
-        today = datetime.date.today()
-        yesterday = today - datetime.timedelta(days=1)
-        today_timestamp = int(
-            datetime.datetime(today.year, today.month, today.day, 0, 0, 0).timestamp()
-        )
-        yesterday_timestamp = int(
-            datetime.datetime(
-                yesterday.year, yesterday.month, yesterday.day, 0, 0, 0
-            ).timestamp()
-        )
 
-        timeframe_tracks = [
-            track
-            for track in recent_tracks
-            if today_timestamp > track.epoch_started > yesterday_timestamp
-        ]
-    elif timeframe == Timeframe.LAST_WEEK:
-        sunday = last_sunday(
-            datetime.date.today() - dateutil.relativedelta.relativedelta(weeks=1)
-        )
+def parse_timeframes(names: str) -> typing.List[Timeframe]:
+    """
+    Parses comma-separated `Timeframe` keys (or `ALL` for every timeframe),
+    raising a `ValueError` for unknown keys
+    """
 
-        timeframe_tracks = [
-            track
-            for track in recent_tracks
-            if 7
-            <= (datetime.date.fromtimestamp(track.epoch_started) - sunday).days
-            <= 14
-        ]
-    elif timeframe == Timeframe.LAST_MONTH:
-        this_month = datetime.date.today()
-        last_month = this_month - dateutil.relativedelta.relativedelta(months=1)
-        this_month_timestamp = int(
-            datetime.datetime(this_month.year, this_month.month, 1, 0, 0, 0).timestamp()
+    if names == "ALL":
+        return list(Timeframe)
+
+    return [
+        list(Timeframe)[Timeframe.list_names().index(name.strip())]
+        for name in names.split(",")
+    ]
+
+
+async def analyze_timeframes(
+    username: str,
+    timeframes: typing.List[Timeframe],
+    store: typing.Union[ScrobbleStore, None] = None,
+    metadata: typing.Union[MetadataStore, None] = None,
+    sketches: typing.Union[
+        typing.Dict[str, typing.Dict[str, HeavyHitters]], None
+    ] = None,
+) -> typing.Union[typing.Dict[str, dict], None]:
+    """
+    Analyzes several timeframes from a single sync of the range covering all
+    of them, slicing each one out of the sorted history. With `sketches`,
+    each timeframe's sketches are merged into the ones for its key.
+    """
+
+    global FULL_RESYNC, HISTORY_OUTPUT
+
+    today = datetime.date.today()
+    timeframe_bounds = {timeframe: timeframe.bounds(today) for timeframe in timeframes}
+    bounds = (
+        min(start for start, _ in timeframe_bounds.values()),
+        max(end for _, end in timeframe_bounds.values()),
+    )
+
+    owns_store = store is None
+    store = store or ScrobbleStore(username)
+    try:
+        # If nothing was scrobbled since the stored analyses were made, they
+        # still hold. Sketches can't be merged from them, and history exports
+        # are written while syncing, so those runs always analyze.
+        latest_epoch = None
+        if sketches is None and not FULL_RESYNC and not HISTORY_OUTPUT:
+            latest_epoch = await get_latest_scrobble(username)
+
+        options = analysis_options()
+        if latest_epoch is not None:
+            stored_analyses = {
+                timeframe.name: store.load_analysis(
+                    timeframe, options, timeframe_bounds[timeframe], latest_epoch
+                )
+                for timeframe in timeframes
+            }
+            if all(analysis is not None for analysis in stored_analyses.values()):
+                print("Nothing was scrobbled since the last analysis")
+                return stored_analyses
+
+        recent_tracks = await get_recent_tracks(bounds, username, store, metadata)
+        if recent_tracks is None:
+            return None
+
+        columns, complete = recent_tracks
+        if not complete:
+            termcolor.cprint(
+                "Some durations couldn't be retrieved, so the analysis isn't stored",
+                "yellow",
+            )
+
+        analyses = {}
+        for timeframe in timeframes:
+            analyses[timeframe.name] = await analyze_timeframe(
+                columns.between(*timeframe_bounds[timeframe]),
+                timeframe,
+                sketches.setdefault(timeframe.name, {})
+                if sketches is not None
+                else None,
+            )
+
+            # Keyed by the newest scrobble from before the sync, so one that
+            # came in during it only means analyzing again next time. Analyses
+            # missing durations aren't stored, so the next run retries them.
+            if latest_epoch is not None and complete:
+                store.save_analysis(
+                    timeframe,
+                    options,
+                    timeframe_bounds[timeframe],
+                    latest_epoch,
+                    analyses[timeframe.name],
+                )
+
+        return analyses
+    finally:
+        if owns_store:
+            store.close()
+
+
+class AnalyzerServer:
+    """
+    Answers analysis requests over local HTTP (or a Unix socket), keeping the
+    HTTP sessions, the caches, and every user's scrobble store open between
+    requests
+    """
+
+    def __init__(self):
+        self.stores: typing.Dict[str, ScrobbleStore] = {}
+        self.metadata: typing.Union[MetadataStore, None] = None
+        self.analyses = SingleFlight()
+        self.user_locks: typing.Dict[str, asyncio.Lock] = {}
+
+    def store(self, username: str) -> ScrobbleStore:
+        if username not in self.stores:
+            self.stores[username] = ScrobbleStore(username)
+
+        return self.stores[username]
+
+    async def analyze(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        """
+        `GET /analyze?username=...&timeframe=...` returns the same JSON as the
+        analyzer's output file for the timeframe (or timeframes)
+        """
+
+        username = request.query.get("username")
+        if not username:
+            return aiohttp.web.json_response(
+                {"error": "A username is required"}, status=400
+            )
+
+        try:
+            timeframes = parse_timeframes(request.query.get("timeframe", "THIS_WEEK"))
+        except ValueError:
+            return aiohttp.web.json_response({"error": "Unknown timeframe"}, status=400)
+
+        # Identical requests share one analysis, and different ones for the
+        # same user wait for the running sync, then only sync what's new
+        analyses = await self.analyses.do(
+            (username, tuple(timeframes)),
+            lambda: self.analyze_user(username, timeframes),
         )
-        last_month_timestamp = int(
-            datetime.datetime(last_month.year, last_month.month, 1, 0, 0, 0).timestamp()
+        if analyses is None:
+            return aiohttp.web.json_response(
+                {"error": "Recent tracks not available"}, status=502
+            )
+
+        return aiohttp.web.json_response(
+            analyses[timeframes[0].name] if len(timeframes) == 1 else analyses
         )
 
-        timeframe_tracks = [
-            track
-            for track in recent_tracks
-            if this_month_timestamp > track.epoch_started > last_month_timestamp
-        ]
-    elif timeframe == Timeframe.LAST_YEAR:
-        this_year = datetime.date.today()
-        last_year = this_year - dateutil.relativedelta.relativedelta(years=1)
-        this_year_timestamp = int(
-            datetime.datetime(this_year.year, 1, 1, 0, 0, 0).timestamp()
+    async def metrics(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        """
+        `GET /metrics` returns the counters since the server started, for
+        Prometheus (or as JSON with `?format=json`)
+        """
+
+        if request.query.get("format") == "json":
+            return aiohttp.web.json_response(METRICS.summary())
+
+        return aiohttp.web.Response(
+            body=METRICS.prometheus().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
         )
-        last_year_timestamp = int(
-            datetime.datetime(last_year.year, 1, 1, 0, 0, 0).timestamp()
+
+    async def analyze_user(
+        self, username: str, timeframes: typing.List[Timeframe]
+    ) -> typing.Union[typing.Dict[str, dict], None]:
+        if self.metadata is None:
+            self.metadata = MetadataStore()
+
+        async with self.user_locks.setdefault(username, asyncio.Lock()):
+            return await analyze_timeframes(
+                username, timeframes, self.store(username), self.metadata
+            )
+
+    async def close(self, _: aiohttp.web.Application) -> None:
+        for store in self.stores.values():
+            store.close()
+        if self.metadata is not None:
+            self.metadata.close()
+
+        await SESSIONS.close()
+
+    def run(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8080,
+        path: typing.Union[str, None] = None,
+    ) -> None:
+        # The server's the only part of the analyzer that needs aiohttp.web
+        import aiohttp.web
+
+        app = aiohttp.web.Application()
+        app.router.add_get("/analyze", self.analyze)
+        app.router.add_get("/metrics", self.metrics)
+        app.on_cleanup.append(self.close)
+
+        if path:
+            aiohttp.web.run_app(app, path=path)
+        else:
+            aiohttp.web.run_app(app, host=host, port=port)
+
+
+async def main(timeframe: Timeframe = Timeframe.LAST_WEEK) -> dict:
+    return (await main_timeframes([timeframe]))[timeframe.name]
+
+
+async def main_timeframes(
+    timeframes: typing.List[Timeframe] = list(Timeframe),
+) -> typing.Dict[str, dict]:
+    try:
+        analyses = await analyze_timeframes(USERNAME, timeframes)
+    finally:
+        await SESSIONS.close()
+
+    if analyses is None:
+        exit(termcolor.colored("Recent tracks not available", "red"))
+
+    return analyses
+
+
+async def main_batch(
+    usernames: typing.List[str],
+    timeframes: typing.List[Timeframe] = list(Timeframe),
+    sketches: typing.Union[
+        typing.Dict[str, typing.Dict[str, HeavyHitters]], None
+    ] = None,
+) -> typing.Dict[str, typing.Union[typing.Dict[str, dict], None]]:
+    """
+    Analyzes every user, syncing up to `BATCH_CONCURRENCY` of them at once.
+    The syncs share each backend's rate limiter, which hands requests out in
+    the order they're made, so the users' pages interleave instead of one
+    user holding up the rest, and they share the metadata store, so a track
+    is only resolved once across all of them.
+    """
+
+    global BATCH_CONCURRENCY
+
+    metadata = MetadataStore()
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def analyze_user(
+        username: str,
+    ) -> typing.Union[typing.Dict[str, dict], None]:
+        async with semaphore:
+            termcolor.cprint(f"Analyzing {username}...", attrs=["bold"])
+            return await analyze_timeframes(
+                username, timeframes, metadata=metadata, sketches=sketches
+            )
+
+    # Users can be listed more than once (e.g. several Discord accounts)
+    usernames = list(dict.fromkeys(usernames))
+    try:
+        analyses = await asyncio.gather(
+            *[analyze_user(username) for username in usernames]
         )
+    finally:
+        metadata.close()
+        await SESSIONS.close()
 
-        timeframe_tracks = [
-            track
-            for track in recent_tracks
-            if this_year_timestamp > track.epoch_started > last_year_timestamp
-        ]
+    return dict(zip(usernames, analyses))
 
-    analyzed_tracks = await analyze_tracks(
-        [
-            RecentTrackWithDuration(
-                track.name,
-                track.mbid,
-                track.artist,
-                track.album,
-                track.now_playing,
-                track.epoch_started,
-                get_duration(track, unique_track_info),
+
+def write_output(
+    username: str, timeframes: typing.List[Timeframe], analyses: typing.Dict[str, dict]
+) -> None:
+    with open(f"user_output_{username}.json", "w") as user_output:
+        user_output.write(
+            json.dumps(
+                analyses[timeframes[0].name] if len(timeframes) == 1 else analyses
             )
-            for track in timeframe_tracks
-        ]
-    )
+        )
 
-    generated_messages = await generate_analysis_messages(analyzed_tracks)
-    generated_messages["tracks"] = (
-        f"You listened to {'{:,}'.format(len(timeframe_tracks))} {basic_pluralize('track', len(timeframe_tracks))}"
-        if not RAW_DUMP
-        else len(timeframe_tracks)
-    )
-    generated_messages["timeframe"] = timeframe.value.lower()
 
-    return [timeframe_tracks, generated_messages]
+def write_metrics(name: str) -> None:
+    """Writes the run's metrics next to the results, if they were asked for"""
+
+    if METRICS_OUTPUT:
+        with open(f"metrics_{name}.json", "w") as metrics_output:
+            metrics_output.write(json.dumps(METRICS.summary()))
+
+    if PROMETHEUS_OUTPUT:
+        with open(f"metrics_{name}.prom", "w") as metrics_output:
+            metrics_output.write(METRICS.prometheus())
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        if len(sys.argv) < 3 or not LAST_FM_API_KEY:
+            exit(
+                termcolor.colored(
+                    f"You must set the {termcolor.colored('LAST_FM_API_KEY', attrs=['bold'])} environment variable and pass a users file!",
+                    "red",
+                )
+            )
+
+        # Either a list of usernames, or the Discord bot's `users.json`
+        with open(sys.argv[2]) as users_file:
+            users = json.load(users_file)
+
+        timeframes = parse_timeframes(os.environ.get("TIMEFRAME", "ALL"))
+        sketches: typing.Dict[str, typing.Dict[str, HeavyHitters]] = {}
+        batch_analyses = asyncio.run(
+            main_batch(
+                list(users.values() if isinstance(users, dict) else users),
+                timeframes,
+                sketches if APPROXIMATE_CAPACITY else None,
+            )
+        )
+
+        for username, analyses in batch_analyses.items():
+            if analyses is None:
+                termcolor.cprint(f"Recent tracks not available for {username}", "red")
+            else:
+                write_output(username, timeframes, analyses)
+
+        write_metrics("batch")
+
+        # The approximate rankings across every user
+        if sketches:
+            with open("server_output.json", "w") as server_output:
+                server_output.write(
+                    json.dumps(
+                        {
+                            timeframe: approximate_ranking(
+                                timeframe_sketches, RANKING_SIZE or 10
+                            )
+                            for timeframe, timeframe_sketches in sketches.items()
+                            if timeframe_sketches
+                        }
+                    )
+                )
+
+        exit()
+
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        if not LAST_FM_API_KEY:
+            exit(
+                termcolor.colored(
+                    f"You must set the {termcolor.colored('LAST_FM_API_KEY', attrs=['bold'])} environment variable!",
+                    "red",
+                )
+            )
+
+        AnalyzerServer().run(ANALYZER_HOST, ANALYZER_PORT, ANALYZER_SOCKET)
+        exit()
+
     if not USERNAME or not LAST_FM_API_KEY:
         exit(
             termcolor.colored(
@@ -1013,16 +3462,16 @@ if __name__ == "__main__":
             )
         )
 
-    timeframe: Timeframe = list(Timeframe)[
-        Timeframe.list_names().index(os.environ.get("TIMEFRAME", "THIS_WEEK"))
-    ]
-    tracks, generated_messages = asyncio.run(main(timeframe))
+    timeframes = parse_timeframes(os.environ.get("TIMEFRAME", "THIS_WEEK"))
 
-    with open(f"user_output_{USERNAME}.json", "w") as user_output:
-        user_output.write(json.dumps(generated_messages))
+    timeframe_messages = asyncio.run(main_timeframes(timeframes))
+
+    write_output(USERNAME, timeframes, timeframe_messages)
+    write_metrics(USERNAME)
 
     if OUTPUT:
-        print()
-        print(f"{timeframe.value.capitalize()}")
-        for message in generated_messages:
-            print(generated_messages[message])
+        for timeframe in timeframes:
+            print()
+            print(f"{timeframe.value.capitalize()}")
+            for message in timeframe_messages[timeframe.name].values():
+                print(message)
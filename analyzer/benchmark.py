@@ -0,0 +1,404 @@
+# Acoustats
+# Copyright (C) 2022 H. Kamran
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Acoustats Benchmark
+Times each stage of an analysis over synthetic histories of several sizes,
+offline and (optionally) synced through the stub server, and writes the
+timings to a JSON report that can be compared between commits
+Contributors:
+    :: H. Kamran [@hkamran80] (author)
+"""
+
+import aiohttp.web
+import stub_server
+import subprocess
+import contextlib
+import acoustats
+import platform
+import datetime
+import tempfile
+import asyncio
+import typing
+import numpy
+import json
+import time
+import sys
+import io
+import os
+
+BENCHMARK_SIZES = [
+    int(size)
+    for size in os.environ.get("BENCHMARK_SIZES", "10000,100000,1000000").split(",")
+]
+# Unique tracks per scrobble
+BENCHMARK_TRACK_RATIO = float(os.environ.get("BENCHMARK_TRACK_RATIO", 0.05))
+# Each stage is run this many times, keeping the fastest
+BENCHMARK_REPEAT = int(os.environ.get("BENCHMARK_REPEAT", 3))
+# If set, the histories are also synced from an in-process stub server
+BENCHMARK_STUB = os.environ.get("BENCHMARK_STUB", False)
+# Requests per second sent to the stub server by each backend
+BENCHMARK_RATE_LIMIT = float(os.environ.get("BENCHMARK_RATE_LIMIT", 1000))
+BENCHMARK_OUTPUT = os.environ.get("BENCHMARK_OUTPUT", "benchmark_output.json")
+BENCHMARK_SEED = int(os.environ.get("BENCHMARK_SEED", 0))
+# The most importing the analyzer may add to the interpreter's startup, in
+# seconds, since the Discord bot starts a new process for every command
+BENCHMARK_IMPORT_BUDGET = float(os.environ.get("BENCHMARK_IMPORT_BUDGET", 0.2))
+
+# Last.fm's default page size, which recent tracks used to be retrieved in
+DEFAULT_PAGE_SIZE = 50
+
+
+class StageTimer:
+    """Keeps the fastest time of each stage across repeats"""
+
+    def __init__(self):
+        self.timings: typing.Dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def measure(self, stage: str) -> typing.Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def record(self, stage: str, elapsed: float) -> None:
+        self.timings[stage] = min(self.timings.get(stage, elapsed), elapsed)
+
+
+def git_commit() -> typing.Union[str, None]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def fill_metadata(server: stub_server.StubServer) -> None:
+    """Stores every track's duration, so enrichment never goes to the network"""
+
+    metadata = acoustats.MetadataStore()
+    for track in server.tracks.values():
+        metadata.put(
+            acoustats.BasicTrackInfo(track.name, track.artist, track.album, ""),
+            acoustats.TrackInfo(
+                track.name,
+                "",
+                acoustats.Artist(track.artist, ""),
+                acoustats.Album(track.album, ""),
+                server.duration(track),
+                0,
+            ),
+            "lastfm",
+        )
+
+    metadata.close()
+
+
+def measure_startup(code: str) -> float:
+    """The fastest time of a fresh interpreter running `code`"""
+
+    timings = []
+    for _ in range(max(BENCHMARK_REPEAT, 5)):
+        started = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", code],
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        timings.append(time.perf_counter() - started)
+
+    return min(timings)
+
+
+def benchmark_import() -> typing.Dict[str, typing.Any]:
+    interpreter = measure_startup("pass")
+    cold_start = measure_startup("import acoustats") - interpreter
+
+    return {
+        "interpreter": interpreter,
+        "import": cold_start,
+        "budget": BENCHMARK_IMPORT_BUDGET,
+        "within_budget": cold_start <= BENCHMARK_IMPORT_BUDGET,
+    }
+
+
+def benchmark_ingestion(server: stub_server.StubServer) -> typing.Dict[str, dict]:
+    """
+    Decodes and parses the whole history with the standard library's decoder
+    at Last.fm's default page size, the way recent tracks used to be
+    retrieved, and with each available decoder at the analyzer's page size
+    """
+
+    decoders: typing.Dict[str, typing.Callable[[bytes], typing.Any]] = {
+        "json": json.loads
+    }
+    if acoustats.orjson is not None:
+        decoders["orjson"] = acoustats.orjson.loads
+
+    timer = StageTimer()
+    page_counts = {}
+    for page_size in (DEFAULT_PAGE_SIZE, acoustats.RECENT_TRACKS_LIMIT):
+        page_counts[page_size] = -(-len(server.history) // page_size)
+        page_decoders = (
+            decoders
+            if page_size == acoustats.RECENT_TRACKS_LIMIT
+            else {"json": json.loads}
+        )
+
+        for _ in range(BENCHMARK_REPEAT):
+            # Pages are rendered one at a time, so only decoding and parsing
+            # them is measured
+            parse_times = dict.fromkeys(page_decoders, 0.0)
+            for page in range(1, page_counts[page_size] + 1):
+                body = json.dumps(
+                    server.recent_tracks_page("benchmark", None, None, page, page_size)
+                ).encode()
+
+                for decoder, loads in page_decoders.items():
+                    started = time.perf_counter()
+                    acoustats.parse_recent_tracks(loads(body))
+                    parse_times[decoder] += time.perf_counter() - started
+
+            for decoder, parse_time in parse_times.items():
+                timer.record(f"{decoder}/{page_size}", parse_time)
+
+    results = {}
+    for configuration, elapsed in timer.timings.items():
+        decoder, page_size = configuration.split("/")
+        pages = page_counts[int(page_size)]
+        results[configuration] = {
+            "decoder": decoder,
+            "page_size": int(page_size),
+            "pages": pages,
+            "seconds": elapsed,
+            "pages_per_second": pages / elapsed if elapsed else None,
+            "scrobbles_per_second": len(server.history) / elapsed if elapsed else None,
+            # Retrieving the pages is bound by Last.fm's rate limit, not parsing
+            "rate_limited_seconds": pages / acoustats.RATE_LIMITS["lastfm"],
+        }
+
+    return results
+
+
+async def benchmark_offline(
+    server: stub_server.StubServer,
+) -> typing.Dict[str, typing.Any]:
+    timer = StageTimer()
+    pages = -(-len(server.history) // acoustats.RECENT_TRACKS_LIMIT)
+
+    for _ in range(BENCHMARK_REPEAT):
+        # Parsed the way the analyzer parses pages, see `benchmark_ingestion`
+        # for the alternatives
+        parse_time = 0.0
+        recent_tracks: typing.List[acoustats.RecentTrack] = []
+        for page in range(1, pages + 1):
+            body = json.dumps(
+                server.recent_tracks_page(
+                    "benchmark", None, None, page, acoustats.RECENT_TRACKS_LIMIT
+                )
+            ).encode()
+
+            started = time.perf_counter()
+            recent_tracks.extend(
+                acoustats.parse_recent_tracks(acoustats.decode_json(body))
+            )
+            parse_time += time.perf_counter() - started
+
+        timer.record("parse", parse_time)
+
+        # Enrichment output is noise here
+        with timer.measure("dedup"), contextlib.redirect_stdout(io.StringIO()):
+            unique_tracks = await acoustats.get_unique_tracks(recent_tracks)
+
+        if unique_tracks is None:
+            raise RuntimeError("No tracks were resolved from the metadata store")
+
+        _, catalog = unique_tracks
+
+        with timer.measure("columns"):
+            columns = acoustats.ScrobbleColumns.from_tracks(recent_tracks)
+
+        with timer.measure("join"):
+            columns.set_durations(catalog)
+
+        with timer.measure("filter"):
+            timeframe_columns = [
+                columns.between(*timeframe.bounds())
+                for timeframe in acoustats.Timeframe
+            ]
+
+        with timer.measure("analyze"):
+            analyses = [
+                await acoustats.analyze_tracks(analyzed_columns)
+                for analyzed_columns in [columns, *timeframe_columns]
+            ]
+
+        with timer.measure("messages"):
+            for analysis in analyses:
+                await acoustats.generate_analysis_messages(analysis)
+
+        del recent_tracks, columns, timeframe_columns
+
+    return {
+        "pages": pages,
+        "stages": timer.timings,
+        "scrobbles_per_second": {
+            stage: len(server.history) / elapsed if elapsed else None
+            for stage, elapsed in timer.timings.items()
+        },
+    }
+
+
+async def benchmark_stub(
+    server: stub_server.StubServer, directory: str
+) -> typing.Dict[str, typing.Any]:
+    """Syncs the whole history from the stub server into an empty store"""
+
+    server.requests.clear()
+    runner = aiohttp.web.AppRunner(server.application())
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+
+    host, port = runner.addresses[0][:2]
+    endpoints = server.environment(f"http://{host}:{port}")
+    acoustats.BASE_URL = endpoints["LAST_FM_URL"]
+    acoustats.SPOTIFY_API_URL = endpoints["SPOTIFY_API_URL"]
+    acoustats.SPOTIFY_ACCOUNTS_URL = endpoints["SPOTIFY_ACCOUNTS_URL"]
+    acoustats.MUSICBRAINZ_URL = endpoints["MUSICBRAINZ_URL"]
+
+    acoustats.LAST_FM_API_KEY = acoustats.LAST_FM_API_KEY or "stub"
+    acoustats.SPOTIFY_CLIENT_ID = acoustats.SPOTIFY_CLIENT_ID or "stub"
+    acoustats.SPOTIFY_CLIENT_SECRET = acoustats.SPOTIFY_CLIENT_SECRET or "stub"
+    acoustats.SESSIONS = acoustats.SessionManager(
+        rate_limits={backend: BENCHMARK_RATE_LIMIT for backend in acoustats.RATE_LIMITS}
+    )
+
+    # A fresh directory each time, so neither the stores nor the HTTP cache
+    # are warm
+    os.chdir(tempfile.mkdtemp(dir=directory))
+    try:
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            recent_tracks = await acoustats.get_recent_tracks(
+                (0, server.epochs[-1] + 1), "benchmark"
+            )
+        elapsed = time.perf_counter() - started
+    finally:
+        await acoustats.SESSIONS.close()
+        await runner.cleanup()
+        os.chdir(directory)
+
+    if recent_tracks is None:
+        raise RuntimeError("The history couldn't be synced from the stub server")
+
+    columns, _ = recent_tracks
+
+    return {
+        "sync": elapsed,
+        "scrobbles_per_second": len(server.history) / elapsed,
+        "scrobbles": columns.play_count(),
+        "requests": dict(server.requests),
+    }
+
+
+async def main() -> dict:
+    results = []
+
+    cold_start = benchmark_import()
+    print(
+        f"Importing the analyzer: {cold_start['import']:.3f}s "
+        f"(budget: {cold_start['budget']:.3f}s)"
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+
+        for size in BENCHMARK_SIZES:
+            tracks = max(int(size * BENCHMARK_TRACK_RATIO), 1)
+            print(f"Benchmarking {size:,} scrobbles of {tracks:,} tracks...")
+
+            started = time.perf_counter()
+            server = stub_server.StubServer(
+                stub_server.synthetic_history(size, tracks, seed=BENCHMARK_SEED),
+                seed=BENCHMARK_SEED,
+            )
+            result: typing.Dict[str, typing.Any] = {
+                "scrobbles": size,
+                "tracks": len(server.tracks),
+                "generate": time.perf_counter() - started,
+            }
+
+            result["ingestion"] = benchmark_ingestion(server)
+            fill_metadata(server)
+            result["offline"] = await benchmark_offline(server)
+            os.remove("analyzer_metadata.sqlite")
+
+            if BENCHMARK_STUB:
+                result["stub"] = await benchmark_stub(server, directory)
+
+            for configuration in result["ingestion"].values():
+                print(
+                    f"  {configuration['decoder']} with {configuration['page_size']} "
+                    f"per page: {configuration['pages']:,} pages, "
+                    f"{configuration['pages_per_second']:,.0f} pages/s "
+                    f"({configuration['scrobbles_per_second']:,.0f} scrobbles/s), "
+                    f"{configuration['rate_limited_seconds']:.0f}s to retrieve"
+                )
+            for stage, elapsed in result["offline"]["stages"].items():
+                print(f"  {stage}: {elapsed:.3f}s")
+            if "stub" in result:
+                print(f"  sync (stub): {result['stub']['sync']:.3f}s")
+
+            results.append(result)
+            del server
+
+    return {
+        "commit": git_commit(),
+        "created": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "track_ratio": BENCHMARK_TRACK_RATIO,
+        "repeat": BENCHMARK_REPEAT,
+        "page_size": acoustats.RECENT_TRACKS_LIMIT,
+        "decoder": "orjson" if acoustats.orjson is not None else "json",
+        "cold_start": cold_start,
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    output_path = os.path.abspath(BENCHMARK_OUTPUT)
+    report = asyncio.run(main())
+
+    with open(output_path, "w") as output:
+        output.write(json.dumps(report, indent=2))
+
+    print(f"Wrote {output_path}")
+
+    # Fail the run, so a slower start is caught like a failing test
+    if not report["cold_start"]["within_budget"]:
+        sys.exit(
+            f"Importing the analyzer took {report['cold_start']['import']:.3f}s, "
+            f"over the {BENCHMARK_IMPORT_BUDGET:.3f}s budget"
+        )
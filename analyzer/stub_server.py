@@ -0,0 +1,455 @@
+# Acoustats
+# Copyright (C) 2022 H. Kamran
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Acoustats Stub Server
+Serves Last.fm, Spotify, and MusicBrainz responses for a synthetic (or
+recorded) listening history, so the analyzer can be run and measured without
+network access or API keys
+Contributors:
+    :: H. Kamran [@hkamran80] (author)
+"""
+
+import collections
+import aiohttp.web
+import itertools
+import datetime
+import hashlib
+import asyncio
+import typing
+import random
+import bisect
+import csv
+import os
+import re
+
+STUB_HOST = os.environ.get("STUB_HOST", "127.0.0.1")
+STUB_PORT = int(os.environ.get("STUB_PORT", 8000))
+# A `tracks_[username].csv` file written with `HISTORY_OUTPUT` to replay,
+# instead of a synthetic history
+STUB_HISTORY = os.environ.get("STUB_HISTORY", None)
+STUB_SCROBBLES = int(os.environ.get("STUB_SCROBBLES", 10000))
+STUB_TRACKS = int(os.environ.get("STUB_TRACKS", 2000))
+STUB_DAYS = int(os.environ.get("STUB_DAYS", 730))
+STUB_SEED = int(os.environ.get("STUB_SEED", 0))
+# Mean added latency of each response, in seconds
+STUB_LATENCY = float(os.environ.get("STUB_LATENCY", 0))
+# Fractions of requests answered with a 429, and (on Last.fm) with error 29
+STUB_THROTTLE_RATE = float(os.environ.get("STUB_THROTTLE_RATE", 0))
+STUB_ERROR_RATE = float(os.environ.get("STUB_ERROR_RATE", 0))
+# Fraction of tracks Last.fm has no duration for, half of which are found on
+# Spotify and the other half on MusicBrainz
+STUB_MISSING_RATE = float(os.environ.get("STUB_MISSING_RATE", 0.1))
+
+Scrobble = collections.namedtuple("Scrobble", "epoch name artist album")
+
+
+def normalize(string: str) -> str:
+    return string.replace("\u2019", "'").casefold().strip()
+
+
+def synthetic_history(
+    scrobbles: int,
+    tracks: int,
+    days: int = 730,
+    seed: int = 0,
+    exponent: float = 1.0,
+    now: typing.Union[int, None] = None,
+) -> typing.List[Scrobble]:
+    """
+    Generates a history of `scrobbles` plays of `tracks` tracks over the last
+    `days` days, oldest first. Track popularity follows Zipf's law, like real
+    listening histories do, and every scrobble has its own timestamp.
+    """
+
+    rng = random.Random(seed)
+    now = now if now is not None else int(datetime.datetime.now().timestamp())
+    span = days * 86400
+
+    catalog = [
+        (
+            f"Track {index}",
+            f"Artist {index % max(tracks // 8, 1)}",
+            f"Album {index % max(tracks // 4, 1)}",
+        )
+        for index in range(tracks)
+    ]
+    plays = rng.choices(
+        catalog,
+        cum_weights=list(
+            itertools.accumulate(1 / rank**exponent for rank in range(1, tracks + 1))
+        ),
+        k=scrobbles,
+    )
+    epochs = sorted(rng.sample(range(now - span, now), min(scrobbles, span)))
+
+    return [
+        Scrobble(epoch, name, artist, album)
+        for epoch, (name, artist, album) in zip(epochs, plays)
+    ]
+
+
+def load_history(path: str) -> typing.List[Scrobble]:
+    """Reads a history written with `HISTORY_OUTPUT`, oldest first"""
+
+    with open(path, newline="") as history_file:
+        return sorted(
+            Scrobble(
+                int(row["epochStarted"]),
+                row["trackName"],
+                row["artistName"],
+                row["albumName"],
+            )
+            for row in csv.DictReader(history_file)
+            if row["nowPlaying"] != "true"
+        )
+
+
+class StubServer:
+    """
+    Answers the requests the analyzer sends to each backend from `history`,
+    with added latency and rate limiting to exercise its retries
+    """
+
+    def __init__(
+        self,
+        history: typing.List[Scrobble],
+        latency: float = 0.0,
+        throttle_rate: float = 0.0,
+        error_rate: float = 0.0,
+        missing_rate: float = 0.1,
+        seed: int = 0,
+    ):
+        self.history = history
+        self.epochs = [scrobble.epoch for scrobble in history]
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.missing_rate = missing_rate
+        self.random = random.Random(seed)
+        self.requests: typing.Counter[str] = collections.Counter()
+
+        self.tracks: typing.Dict[typing.Tuple[str, str], Scrobble] = {}
+        for scrobble in history:
+            self.tracks.setdefault(
+                (normalize(scrobble.name), normalize(scrobble.artist)), scrobble
+            )
+
+        self.ids = {self.track_id(track): track for track in self.tracks.values()}
+
+    def digest(self, track: Scrobble) -> int:
+        return int.from_bytes(
+            hashlib.blake2b(
+                f"{normalize(track.name)}\0{normalize(track.artist)}".encode(),
+                digest_size=8,
+            ).digest(),
+            "little",
+        )
+
+    def duration(self, track: Scrobble) -> int:
+        """Between two and six minutes, the same every time for each track"""
+        return 120000 + self.digest(track) % 240000
+
+    def source(self, track: Scrobble) -> str:
+        """Which backend has the track's duration"""
+
+        digest = self.digest(track)
+        if (digest >> 32) % 10000 >= self.missing_rate * 10000:
+            return "lastfm"
+
+        return "spotify" if digest % 2 == 0 else "musicbrainz"
+
+    def track_id(self, track: Scrobble) -> str:
+        """Stands in for both the Spotify id and the MusicBrainz recording id"""
+        return hashlib.blake2b(
+            f"{track.name}\0{track.artist}".encode(), digest_size=11
+        ).hexdigest()
+
+    def lookup(self, name: str, artist: str) -> typing.Union[Scrobble, None]:
+        return self.tracks.get((normalize(name), normalize(artist)))
+
+    async def inject(
+        self, backend: str, request: aiohttp.web.Request
+    ) -> typing.Union[aiohttp.web.Response, None]:
+        """Delays the response, and rate limits some of the requests"""
+
+        self.requests[backend] += 1
+        if self.latency:
+            await asyncio.sleep(self.random.expovariate(1 / self.latency))
+
+        roll = self.random.random()
+        if roll < self.throttle_rate:
+            self.requests[f"{backend}_throttled"] += 1
+            return aiohttp.web.json_response(
+                {"error": 29, "message": "Rate Limit Exceeded"},
+                status=429 if backend != "musicbrainz" else 503,
+                headers={"Retry-After": "1"},
+            )
+
+        # Last.fm also reports rate limiting with a successful status code
+        if backend == "lastfm" and roll < self.throttle_rate + self.error_rate:
+            self.requests[f"{backend}_errors"] += 1
+            return aiohttp.web.json_response(
+                {"error": 29, "message": "Rate Limit Exceeded"}
+            )
+
+        return None
+
+    async def lastfm(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        injected = await self.inject("lastfm", request)
+        if injected:
+            return injected
+
+        method = request.query.get("method")
+        if method == "user.getRecentTracks":
+            return self.recent_tracks(request)
+        elif method == "track.getInfo":
+            return self.track_info(request)
+
+        return aiohttp.web.json_response(
+            {"error": 3, "message": "Invalid Method - No method with that name"}
+        )
+
+    def recent_tracks(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        return aiohttp.web.json_response(
+            self.recent_tracks_page(
+                request.query.get("user", ""),
+                int(request.query["from"]) if "from" in request.query else None,
+                int(request.query["to"]) if "to" in request.query else None,
+                int(request.query.get("page", 1)),
+                int(request.query.get("limit", 50)),
+            )
+        )
+
+    def recent_tracks_page(
+        self,
+        user: str,
+        start: typing.Union[int, None],
+        end: typing.Union[int, None],
+        page: int = 1,
+        limit: int = 50,
+    ) -> dict:
+        """A `user.getRecentTracks` page of the scrobbles in `[start, end]`"""
+
+        # Last.fm's bounds are inclusive, and pages go from newest to oldest
+        limit = min(max(limit, 1), 200)
+        page = max(page, 1)
+        low = bisect.bisect_left(self.epochs, start or 0)
+        high = (
+            len(self.epochs) if end is None else bisect.bisect_right(self.epochs, end)
+        )
+        total = high - low
+
+        page_tracks = [
+            {
+                "artist": {"mbid": "", "#text": scrobble.artist},
+                "album": {"mbid": "", "#text": scrobble.album},
+                "mbid": "",
+                "name": scrobble.name,
+                "date": {
+                    "uts": str(scrobble.epoch),
+                    "#text": datetime.datetime.fromtimestamp(
+                        scrobble.epoch, datetime.timezone.utc
+                    ).strftime("%d %b %Y, %H:%M"),
+                },
+            }
+            for scrobble in reversed(
+                self.history[
+                    max(high - page * limit, low) : max(high - (page - 1) * limit, low)
+                ]
+            )
+        ]
+
+        return {
+            "recenttracks": {
+                # Pages with a single scrobble return it as an object
+                "track": page_tracks[0] if len(page_tracks) == 1 else page_tracks,
+                "@attr": {
+                    "user": user,
+                    "page": str(page),
+                    "perPage": str(limit),
+                    "totalPages": str(-(-total // limit)),
+                    "total": str(total),
+                },
+            }
+        }
+
+    def track_info(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        track = self.lookup(
+            request.query.get("track", ""), request.query.get("artist", "")
+        )
+        if not track:
+            return aiohttp.web.json_response({"error": 6, "message": "Track not found"})
+
+        return aiohttp.web.json_response(
+            {
+                "track": {
+                    "name": track.name,
+                    "mbid": "",
+                    "url": "",
+                    "duration": str(
+                        self.duration(track) if self.source(track) == "lastfm" else 0
+                    ),
+                    "listeners": "1",
+                    "playcount": str(self.digest(track) % 100000),
+                    "artist": {"name": track.artist, "mbid": "", "url": ""},
+                    "album": {"artist": track.artist, "title": track.album},
+                }
+            }
+        )
+
+    def spotify_track(self, track: Scrobble) -> dict:
+        return {
+            "id": self.track_id(track),
+            "name": track.name,
+            "duration_ms": self.duration(track),
+            "artists": [{"name": track.artist}],
+            "album": {"name": track.album},
+        }
+
+    async def spotify_token(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        self.requests["spotify_token"] += 1
+        return aiohttp.web.json_response(
+            {"access_token": "stub", "token_type": "Bearer", "expires_in": 3600}
+        )
+
+    async def spotify_search(
+        self, request: aiohttp.web.Request
+    ) -> aiohttp.web.Response:
+        injected = await self.inject("spotify", request)
+        if injected:
+            return injected
+
+        fields = dict(re.findall(r'(\w+):"([^"]*)"', request.query.get("q", "")))
+        track = self.lookup(fields.get("track", ""), fields.get("artist", ""))
+
+        return aiohttp.web.json_response(
+            {
+                "tracks": {
+                    "items": [self.spotify_track(track)]
+                    if track and self.source(track) != "musicbrainz"
+                    else []
+                }
+            }
+        )
+
+    async def spotify_tracks(
+        self, request: aiohttp.web.Request
+    ) -> aiohttp.web.Response:
+        injected = await self.inject("spotify", request)
+        if injected:
+            return injected
+
+        return aiohttp.web.json_response(
+            {
+                "tracks": [
+                    self.spotify_track(self.ids[spotify_id])
+                    if spotify_id in self.ids
+                    else None
+                    for spotify_id in request.query.get("ids", "").split(",")
+                ]
+            }
+        )
+
+    def musicbrainz_recording(self, track: Scrobble) -> dict:
+        return {
+            "id": self.track_id(track),
+            "score": 100,
+            "title": track.name,
+            "length": self.duration(track),
+            "artist-credit": [{"name": track.artist}],
+        }
+
+    async def musicbrainz_search(
+        self, request: aiohttp.web.Request
+    ) -> aiohttp.web.Response:
+        injected = await self.inject("musicbrainz", request)
+        if injected:
+            return injected
+
+        recordings = []
+        for name, artist in re.findall(
+            r'recording:"((?:[^"\\]|\\.)*)" AND artist:"((?:[^"\\]|\\.)*)"',
+            request.query.get("query", ""),
+        ):
+            track = self.lookup(
+                re.sub(r"\\(.)", r"\1", name), re.sub(r"\\(.)", r"\1", artist)
+            )
+            if track and self.source(track) != "spotify":
+                recordings.append(self.musicbrainz_recording(track))
+
+        return aiohttp.web.json_response(
+            {"count": len(recordings), "offset": 0, "recordings": recordings}
+        )
+
+    async def musicbrainz_lookup(
+        self, request: aiohttp.web.Request
+    ) -> aiohttp.web.Response:
+        injected = await self.inject("musicbrainz", request)
+        if injected:
+            return injected
+
+        track = self.ids.get(request.match_info["mbid"])
+        if not track:
+            return aiohttp.web.json_response({"error": "Not Found"}, status=404)
+
+        return aiohttp.web.json_response(self.musicbrainz_recording(track))
+
+    async def stats(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        return aiohttp.web.json_response(dict(self.requests))
+
+    def application(self) -> aiohttp.web.Application:
+        app = aiohttp.web.Application()
+        app.router.add_get("/2.0/", self.lastfm)
+        app.router.add_post("/api/token", self.spotify_token)
+        app.router.add_get("/v1/search", self.spotify_search)
+        app.router.add_get("/v1/tracks", self.spotify_tracks)
+        app.router.add_get("/ws/2/recording", self.musicbrainz_search)
+        app.router.add_get("/ws/2/recording/{mbid}", self.musicbrainz_lookup)
+        app.router.add_get("/stats", self.stats)
+
+        return app
+
+    def environment(self, base_url: str) -> typing.Dict[str, str]:
+        """The environment variables pointing the analyzer at this server"""
+
+        return {
+            "LAST_FM_URL": f"{base_url}/2.0/",
+            "SPOTIFY_API_URL": f"{base_url}/v1",
+            "SPOTIFY_ACCOUNTS_URL": f"{base_url}/api/token",
+            "MUSICBRAINZ_URL": f"{base_url}/ws/2",
+        }
+
+
+if __name__ == "__main__":
+    server = StubServer(
+        load_history(STUB_HISTORY)
+        if STUB_HISTORY
+        else synthetic_history(STUB_SCROBBLES, STUB_TRACKS, STUB_DAYS, STUB_SEED),
+        STUB_LATENCY,
+        STUB_THROTTLE_RATE,
+        STUB_ERROR_RATE,
+        STUB_MISSING_RATE,
+        STUB_SEED,
+    )
+
+    print(f"Serving {len(server.history)} scrobbles of {len(server.tracks)} tracks")
+    for key, value in server.environment(f"http://{STUB_HOST}:{STUB_PORT}").items():
+        print(f"{key}={value}")
+
+    aiohttp.web.run_app(
+        server.application(), host=STUB_HOST, port=STUB_PORT, print=None
+    )
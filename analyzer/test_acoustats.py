@@ -0,0 +1,59 @@
+import acoustats
+import pytest
+
+
+def skewed_columns() -> acoustats.ScrobbleColumns:
+    """One track played 100 times among 50 tracks played once each"""
+
+    columns = acoustats.ScrobbleColumns()
+    for epoch in range(100):
+        columns.append("Hit", "Artist 0", "Album 0", epoch)
+    for track in range(50):
+        columns.append(f"Track {track}", f"Artist {track}", None, 100 + track)
+
+    return columns
+
+
+def test_sketch_columns_never_counts_exactly(monkeypatch: pytest.MonkeyPatch):
+    def exact_count(*_, **__):
+        raise AssertionError("The sketches must not be built from exact counts")
+
+    monkeypatch.setattr(acoustats, "rank", exact_count)
+    monkeypatch.setattr(acoustats.numpy, "bincount", exact_count)
+
+    sketches = acoustats.sketch_columns(skewed_columns(), 5)
+
+    for sketch in sketches.values():
+        assert len(sketch.counters.counts) <= 5
+
+    (track, plays, error), *_ = sketches["tracks"].top(1)
+    assert track == ("Hit", "Artist 0")
+    assert plays - error <= 100 <= plays
+
+    # Scrobbles without an album aren't counted as one
+    assert [album for album, *_ in sketches["albums"].top()] == ["Album 0"]
+
+
+def test_sketch_columns_adds_daily_plays_at_once():
+    columns = acoustats.ScrobbleColumns()
+    columns.append("Hit", "Artist 0", "Album 0", 0, plays=30)
+    columns.append("Hit", "Artist 0", "Album 0", 86400, plays=12)
+
+    sketches = acoustats.sketch_columns(columns, 5)
+
+    assert sketches["tracks"].top() == [(("Hit", "Artist 0"), 42, 0)]
+
+
+def test_add_column_matches_adding_each_row():
+    columns = skewed_columns()
+    column_sketch = acoustats.HeavyHitters(5)
+    column_sketch.add_column(columns.albums, columns.album_ids, columns.plays)
+
+    row_sketch = acoustats.HeavyHitters(5)
+    for album_id, plays in zip(columns.album_ids, columns.plays):
+        if album_id >= 0:
+            row_sketch.add(columns.albums[album_id], plays)
+
+    assert (column_sketch.sketch.table == row_sketch.sketch.table).all()
+    assert column_sketch.sketch.total == row_sketch.sketch.total
+    assert column_sketch.top() == row_sketch.top()
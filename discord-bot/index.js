@@ -22,6 +22,7 @@ const { Client, Intents, MessageEmbed } = require("discord.js");
 const { existsSync, writeFileSync, readFileSync, stat } = require("fs");
 const { unlink } = require("fs/promises");
 const { exec } = require("child_process");
+const http = require("http");
 
 const token = process.env.DISCORD_TOKEN;
 
@@ -74,6 +75,101 @@ const titleCase = (string) =>
         .map((w) => w[0].toUpperCase() + w.substr(1).toLowerCase())
         .join(" ");
 
+/**
+ *
+ * @param {string} commandName - The command name
+ * @param {boolean} isMessageDM - Whether the message is a DM or not
+ * @param {string} label - The time period
+ * @param {Interaction} interaction - The Discord.js interaction
+ * @param {object} user_output - The analyzer's output
+ * @returns null
+ */
+const sendStatistics = (
+    commandName,
+    isMessageDM,
+    label,
+    interaction,
+    user_output,
+) => {
+    let message = null;
+    if (commandName === "get-all-stats") {
+        message = `${user_output["tracks"]} (${user_output[
+            "duration"
+        ].replace("You listened for ", "")}).\n\n${
+            user_output["toptrack"]
+        }\n${user_output["topartist"]}\n${user_output["topalbum"]}`;
+    } else if (commandName === "get-top-tracks") {
+        message = user_output["toptrack"];
+    } else if (commandName === "get-top-artists") {
+        message = user_output["topartist"];
+    } else if (commandName === "get-top-albums") {
+        message = user_output["topalbum"];
+    } else if (commandName === "get-duration") {
+        message = user_output["duration"];
+    } else if (commandName === "get-track-count") {
+        message = user_output["tracks"];
+    }
+
+    // interaction.user.send({
+    //     embeds: [
+    //         new MessageEmbed()
+    //             .setColor("#BE185D")
+    //             .setTitle(`Acoustats for ${titleCase(label)}`)
+    //             .setDescription(message),
+    //     ],
+    // });
+    // if (!isMessageDM) {
+    interaction.followUp({
+        embeds: [
+            new MessageEmbed()
+                .setColor("#BE185D")
+                .setTitle(`Acoustats for ${titleCase(label)}`)
+                .setDescription(message),
+        ],
+        ephemeral: !isMessageDM,
+    });
+    // }
+};
+
+/**
+ * Requests an analysis from a running analyzer server (`acoustats.py serve`)
+ *
+ * @param {string} lastfmUsername - The Last.fm username
+ * @param {string} timeframe - The timeframe key
+ * @param {function} callback - Called with the error, if any, and the analyzer's output
+ * @returns null
+ */
+const requestAnalysis = (lastfmUsername, timeframe, callback) => {
+    const path = `/analyze?${new URLSearchParams({
+        username: lastfmUsername,
+        timeframe,
+    }).toString()}`;
+
+    const request = http.get(
+        process.env.ANALYZER_SOCKET
+            ? { socketPath: process.env.ANALYZER_SOCKET, path }
+            : `${process.env.ANALYZER_URL}${path}`,
+        (response) => {
+            let body = "";
+            response.setEncoding("utf8");
+            response.on("data", (chunk) => (body += chunk));
+            response.on("end", () => {
+                if (response.statusCode !== 200) {
+                    callback(
+                        new Error(
+                            `Analyzer responded with ${response.statusCode}: ${body}`,
+                        ),
+                        null,
+                    );
+                } else {
+                    callback(null, JSON.parse(body));
+                }
+            });
+        },
+    );
+    request.on("error", (error) => callback(error, null));
+};
+
 /**
  *
  * @param {string} commandName - The command name
@@ -113,11 +209,11 @@ const postAnalysis = (
         ) {
             console.log("Deleting cached responses and restarting...");
 
-            unlink(`../analyzer/analyzer_lastfm_user_${lastfmUsername}.sqlite`);
+            unlink(`../analyzer/analyzer_scrobbles_${lastfmUsername}.sqlite`);
 
             console.log(
                 existsSync(
-                    `../analyzer/analyzer_lastfm_user_${lastfmUsername}.sqlite`,
+                    `../analyzer/analyzer_scrobbles_${lastfmUsername}.sqlite`,
                 ),
             );
 
@@ -172,50 +268,17 @@ const postAnalysis = (
                     }${label.toLowerCase()} completed`,
                 );
 
-                const user_output = JSON.parse(
-                    readFileSync(
-                        `../analyzer/user_output_${lastfmUsername}.json`,
+                sendStatistics(
+                    commandName,
+                    isMessageDM,
+                    label,
+                    interaction,
+                    JSON.parse(
+                        readFileSync(
+                            `../analyzer/user_output_${lastfmUsername}.json`,
+                        ),
                     ),
                 );
-
-                let message = null;
-                if (commandName === "get-all-stats") {
-                    message = `${user_output["tracks"]} (${user_output[
-                        "duration"
-                    ].replace("You listened for ", "")}).\n\n${
-                        user_output["toptrack"]
-                    }\n${user_output["topartist"]}\n${user_output["topalbum"]}`;
-                } else if (commandName === "get-top-tracks") {
-                    message = user_output["toptrack"];
-                } else if (commandName === "get-top-artists") {
-                    message = user_output["topartist"];
-                } else if (commandName === "get-top-albums") {
-                    message = user_output["topalbum"];
-                } else if (commandName === "get-duration") {
-                    message = user_output["duration"];
-                } else if (commandName === "get-track-count") {
-                    message = user_output["tracks"];
-                }
-
-                // interaction.user.send({
-                //     embeds: [
-                //         new MessageEmbed()
-                //             .setColor("#BE185D")
-                //             .setTitle(`Acoustats for ${titleCase(label)}`)
-                //             .setDescription(message),
-                //     ],
-                // });
-                // if (!isMessageDM) {
-                interaction.followUp({
-                    embeds: [
-                        new MessageEmbed()
-                            .setColor("#BE185D")
-                            .setTitle(`Acoustats for ${titleCase(label)}`)
-                            .setDescription(message),
-                    ],
-                    ephemeral: !isMessageDM,
-                });
-                // }
             }
         }
     });
@@ -352,7 +415,7 @@ client.on("interactionCreate", async (interaction) => {
 
             if (
                 !existsSync(
-                    `../analyzer/analyzer_lastfm_user_${lastfmUsername}.sqlite`,
+                    `../analyzer/analyzer_scrobbles_${lastfmUsername}.sqlite`,
                 )
             ) {
                 console.log(`[${startTime}] Retrieving fresh statistics...`);
@@ -370,25 +433,66 @@ client.on("interactionCreate", async (interaction) => {
                 });
             }
 
-            exec(
-                `cd ../analyzer; ${getPythonPath()} acoustats.py`,
-                {
-                    env: finalEnvVars,
-                },
-                // eslint-disable-next-line no-unused-vars
-                (execError, _, stderr) =>
-                    postAnalysis(
-                        commandName,
-                        isMessageDM,
-                        label,
-                        lastfmUsername,
-                        interaction,
-                        finalEnvVars,
-                        startTime,
-                        execError,
-                        stderr,
-                    ),
-            );
+            if (process.env.ANALYZER_SOCKET || process.env.ANALYZER_URL) {
+                requestAnalysis(
+                    lastfmUsername,
+                    value.toUpperCase(),
+                    (error, user_output) => {
+                        if (error) {
+                            postAnalysis(
+                                commandName,
+                                isMessageDM,
+                                label,
+                                lastfmUsername,
+                                interaction,
+                                finalEnvVars,
+                                startTime,
+                                error,
+                                "",
+                            );
+                            return;
+                        }
+
+                        console.log(
+                            `[${new Date().getTime()}] ${capitalizeFirstLetter(
+                                commandName.replace("get-", "").replace("-", " "),
+                            )} retrieval for ${
+                                label.toLowerCase().indexOf("last") > -1
+                                    ? "the "
+                                    : ""
+                            }${label.toLowerCase()} completed`,
+                        );
+
+                        sendStatistics(
+                            commandName,
+                            isMessageDM,
+                            label,
+                            interaction,
+                            user_output,
+                        );
+                    },
+                );
+            } else {
+                exec(
+                    `cd ../analyzer; ${getPythonPath()} acoustats.py`,
+                    {
+                        env: finalEnvVars,
+                    },
+                    // eslint-disable-next-line no-unused-vars
+                    (execError, _, stderr) =>
+                        postAnalysis(
+                            commandName,
+                            isMessageDM,
+                            label,
+                            lastfmUsername,
+                            interaction,
+                            finalEnvVars,
+                            startTime,
+                            execError,
+                            stderr,
+                        ),
+                );
+            }
         }
     }
 });